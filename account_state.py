@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import metrics
+from trigger_engine import normalize_side
+
+# Seconds between REST snapshots that reconcile the mirror with the exchange
+ACCOUNT_STATE_RECONCILE_INTERVAL = int(os.environ.get('ACCOUNT_STATE_RECONCILE_INTERVAL', 60))
+# The mirror is trusted for entry checks only while the last successful snapshot is younger than this
+ACCOUNT_STATE_MAX_AGE = int(os.environ.get('ACCOUNT_STATE_MAX_AGE', 180))
+
+# (symbol, side, quantity, trigger price)
+Conditional = Tuple[str, str, float, float]
+
+
+class AccountState:
+    """
+    Open positions and untriggered conditional orders per symbol and side, mirrored from the private streams.
+
+    The position and stop order handlers keep it current between REST snapshots. Duplicate-entry checks read
+    it locally while it is fresh, and fall back to REST once a snapshot fails or is overdue.
+    """
+
+    def __init__(self):
+        self.positions: Dict[Tuple[str, str], float] = {}
+        self.conditionals: Dict[str, Conditional] = {}
+        self.snapshot_at: Optional[float] = None
+        # Stream changes made while a REST snapshot is being fetched, as (positions or conditionals, key, value).
+        # They are newer than the snapshot, so they are applied again on top of it. None when no fetch is running
+        self.changes: Optional[List[Tuple[str, object, object]]] = None
+        self.lock = threading.Lock()
+
+    def is_fresh(self) -> bool:
+        snapshot_at = self.snapshot_at
+        return snapshot_at is not None and time() - snapshot_at < ACCOUNT_STATE_MAX_AGE
+
+    def mark_stale(self):
+        self.snapshot_at = None
+
+    def has_position(self, symbol: str, side: str) -> bool:
+        return self.positions.get((symbol.upper(), normalize_side(side)), 0) > 0
+
+    def has_conditional(self, symbol: str, side: str, qty: float, trigger_price: float) -> bool:
+        wanted = (symbol.upper(), normalize_side(side), float(qty), float(trigger_price))
+        with self.lock:
+            return wanted in self.conditionals.values()
+
+    def on_position(self, update: dict):
+        symbol = str(update["symbol"]).upper()
+        side = normalize_side(update["side"])
+        with self.lock:
+            self.__apply("positions", (symbol, side), float(update["size"]))
+
+    def on_stop_order(self, update: dict):
+        order_id = self.__order_id(update)
+        if order_id is None:
+            return
+        with self.lock:
+            self.__apply("conditionals", order_id, self.__conditional(update) if update.get("order_status") == "Untriggered" else None)
+
+    def add_conditional(self, order_id: str, symbol: str, side: str, qty: float, trigger_price: float):
+        # Recorded as soon as the order is accepted so a re-trigger cannot slip in before the stream confirms it
+        with self.lock:
+            self.__apply("conditionals", order_id, (symbol.upper(), normalize_side(side), float(qty), float(trigger_price)))
+
+    def reconcile(self, exchange_client, symbols: Iterable[str]) -> bool:
+        """
+        Replaces the mirror with one REST snapshot of all positions plus the untriggered conditionals on `symbols`.
+        Stream changes that arrive while it is fetched are kept, since the snapshot may predate them.
+        """
+        with self.lock:
+            self.changes = []
+        try:
+            positions: Dict[Tuple[str, str], float] = {}
+            response = exchange_client.my_position(background=True)
+            for entry in (response or {}).get("result") or []:
+                position = entry.get("data", entry)
+                positions[(str(position["symbol"]).upper(), normalize_side(position["side"]))] = float(position["size"])
+            conditionals: Dict[str, Conditional] = {}
+            # Bybit has no account-wide conditional order query, so this is one call per watched symbol
+            for symbol in set(symbol.upper() for symbol in symbols):
+                response = exchange_client.query_conditional_order(symbol=symbol, background=True)
+                for order in (response or {}).get("result") or []:
+                    order_id = self.__order_id(order)
+                    if order_id is not None and order.get("order_status", "Untriggered") == "Untriggered":
+                        conditionals[order_id] = self.__conditional(order)
+        except Exception:
+            with self.lock:
+                self.changes = None
+            metrics.REST_ERRORS.inc("account_snapshot")
+            logging.exception("Exception occurred reconciling account state. Entry checks will fall back to REST: ")
+            self.mark_stale()
+            return False
+        with self.lock:
+            changes, self.changes = self.changes, None
+            self.positions = positions
+            self.conditionals = conditionals
+            for target, key, value in changes:
+                self.__apply(target, key, value)
+            self.snapshot_at = time()
+        return True
+
+    def to_snapshot(self) -> dict:
+        with self.lock:
+            return {"snapshot_at": self.snapshot_at, "positions": [[symbol, side, size] for (symbol, side), size in self.positions.items()],
+                    "conditionals": {order_id: list(conditional) for order_id, conditional in self.conditionals.items()}}
+
+    def restore(self, snapshot: dict):
+        """
+        Loads a mirror written before a restart. Private events sent while the bot was down were missed, so it is
+        loaded stale and entry checks go to REST until the first reconcile succeeds.
+        """
+        with self.lock:
+            self.positions = {(symbol, side): float(size) for symbol, side, size in snapshot["positions"]}
+            self.conditionals = {order_id: (symbol, side, float(qty), float(price)) for order_id, (symbol, side, qty, price) in snapshot["conditionals"].items()}
+            self.snapshot_at = None
+
+    def __apply(self, target: str, key, value):
+        # Called with the lock held. A value of None removes the entry
+        entries = self.positions if target == "positions" else self.conditionals
+        if value is None:
+            entries.pop(key, None)
+        else:
+            entries[key] = value
+        if self.changes is not None:
+            self.changes.append((target, key, value))
+
+    @staticmethod
+    def __order_id(order: dict) -> Optional[str]:
+        # Our own orders are keyed by order_link_id, which is known before the exchange assigns a stop_order_id
+        order_id = order.get("order_link_id") or order.get("stop_order_id")
+        return None if not order_id else str(order_id)
+
+    @staticmethod
+    def __conditional(order: dict) -> Conditional:
+        return str(order["symbol"]).upper(), normalize_side(order["side"]), float(order["qty"]), float(order["trigger_price"])
@@ -0,0 +1,320 @@
+"""
+Benchmarks for the hot paths, run against a scratch SQLite database seeded with generated trades.
+
+Bybit is replaced by the ReplayWebsocket and SimulatedExchange stand-ins from replay.py, and prices stay in the
+in-process PriceCache with the Redis mirror disabled, so runs need no network and are repeatable for a given seed.
+The API is measured through the Flask test client, which covers routing, validation and the DAO but not the socket.
+
+    python benchmark.py --trades 10000 --symbols 200 --ticks 50000 --output before.json
+    python benchmark.py --trades 500000 --symbols 500 --only dao trigger_sweep
+
+Results are written as one JSON document with the run parameters under "meta" and one entry per benchmark under
+"results". Latencies are in seconds.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+from time import perf_counter, sleep, time
+from typing import Callable, Dict, List
+
+BENCHMARKS = ["price_cache", "dao", "trigger_sweep", "ticks", "api"]
+QUANTITIES = [0.001, 0.01, 0.1, 1.0, 10.0]
+# Each API route is called until this many requests or this many seconds, whichever comes first
+API_REQUESTS = 2000
+API_SECONDS = 5.0
+
+
+def symbol_name(index: int) -> str:
+    return "SYM%03dUSDT" % index
+
+
+def base_price(index: int) -> float:
+    return 10.0 * (index + 1)
+
+
+def seed_trades(db_path: str, trades: int, symbols: int, rng: random.Random):
+    """Inserts `trades` active trades spread across `symbols` symbols, in one transaction."""
+    from models import Schema
+    Schema()
+    rows = []
+    for _ in range(trades):
+        index = rng.randrange(symbols)
+        side = rng.choice(["Buy", "Sell"])
+        open_price = round(base_price(index) * rng.uniform(0.9, 1.1), 2)
+        # Buys arm below the trigger and Sells above it, matching validate_side_prices
+        direction = 1 if side == "Buy" else -1
+        trigger = round(open_price * (1 + direction * 0.01), 2)
+        sl = round(open_price * (1 - direction * 0.02), 2)
+        tp = round(open_price * (1 + direction * 0.05), 2)
+        rows.append((symbol_name(index), side, rng.choice(QUANTITIES), open_price, trigger, sl, tp, 1))
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany('insert into trades (symbol, side, quantity, open_conditional_price, trigger_price, sl_price, tp_price, max_sl_count) values (?,?,?,?,?,?,?,?)', rows)
+    conn.close()
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    if len(samples) == 0:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered), "mean": sum(ordered) / len(ordered), "p50": ordered[len(ordered) // 2],
+        "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], "max": ordered[-1],
+    }
+
+
+def histogram_summary(histogram) -> Dict[str, float]:
+    """Mean and bucket upper bounds for the median and 99th percentile of a metrics.Histogram."""
+    total = sum(histogram.counts)
+    if total == 0:
+        return {"count": 0}
+    summary = {"count": total, "mean": histogram.sum / total}
+    for name, quantile in (("p50", 0.5), ("p99", 0.99)):
+        cumulative = 0
+        for bound, count in zip(list(histogram.buckets) + [float("inf")], histogram.counts):
+            cumulative += count
+            if cumulative >= quantile * total:
+                summary[name] = bound
+                break
+    return summary
+
+
+def time_calls(call: Callable[[], object], iterations: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(iterations):
+        start = perf_counter()
+        call()
+        samples.append(perf_counter() - start)
+    result = summarize(samples)
+    result["ops_per_second"] = iterations / sum(samples) if sum(samples) > 0 else 0
+    return result
+
+
+def bench_price_cache(symbols: int, iterations: int, rng: random.Random) -> dict:
+    from price_cache import PriceCache
+    cache = PriceCache()
+    names = [symbol_name(index) for index in range(symbols)]
+    start = perf_counter()
+    for _ in range(iterations):
+        index = rng.randrange(symbols)
+        cache.upsert_price(names[index], base_price(index), time())
+    upsert_seconds = perf_counter() - start
+    start = perf_counter()
+    for _ in range(iterations):
+        cache.read_price(names[rng.randrange(symbols)])
+    read_seconds = perf_counter() - start
+    return {
+        "upserts_per_second": iterations / upsert_seconds,
+        "reads_per_second": iterations / read_seconds,
+        "read_prices_all_symbols": time_calls(lambda: cache.read_prices(names), 200),
+    }
+
+
+def bench_dao(symbols: int, iterations: int, rng: random.Random) -> dict:
+    from models import TradesDao
+    start = perf_counter()
+    dao = TradesDao()
+    load_seconds = perf_counter() - start
+    trades = dao.list_items()
+    sample = iter([rng.choice(trades) for _ in range(iterations * 3)])
+
+    def query_symbol_side():
+        trade = next(sample)
+        dao.query_trades(symbol=trade["symbol"], side=trade["side"])
+
+    def query_symbol_side_qty():
+        trade = next(sample)
+        dao.query_trades(trade["symbol"], trade["side"], trade["quantity"])
+
+    return {
+        "active_trades": len(trades),
+        "index_load_seconds": load_seconds,
+        "list_items": time_calls(dao.list_items, 20),
+        "query_trades_symbol_side": time_calls(query_symbol_side, iterations),
+        "query_trades_symbol_side_qty": time_calls(query_symbol_side_qty, iterations),
+        "get_by_id": time_calls(lambda: dao.get_by_id(next(sample)["id"]), iterations),
+    }
+
+
+def bench_trigger_sweep(symbols: int, rng: random.Random) -> dict:
+    # The same work Strategy.start_reconciliation does every STRATEGY_RECONCILE_INTERVAL: rebuild the books, then
+    # evaluate every symbol against its cached price
+    from models import TradesDao
+    from trigger_engine import TriggerEngine
+    trades = TradesDao().list_items()
+    fired = []
+    engine = TriggerEngine(fired.append)
+    prices = {symbol_name(index): base_price(index) * rng.uniform(0.95, 1.05) for index in range(symbols)}
+    loads, sweeps, idle_sweeps = [], [], []
+    for _ in range(5):
+        start = perf_counter()
+        engine.load(trades)
+        loads.append(perf_counter() - start)
+        start = perf_counter()
+        engine.sweep(prices)
+        sweeps.append(perf_counter() - start)
+        # The usual case in production: ticks have already fired everything the prices cross
+        start = perf_counter()
+        engine.sweep(prices)
+        idle_sweeps.append(perf_counter() - start)
+    return {"trades": len(trades), "symbols": len(prices), "columnar": engine.columns is not None, "load": summarize(loads),
+            "sweep": summarize(sweeps), "idle_sweep": summarize(idle_sweeps), "fired_per_sweep": len(fired) // 5}
+
+
+def bench_ticks(symbols: int, ticks: int, rng: random.Random) -> dict:
+    """Full tick path: websocket callback, coalescing, price cache, trigger books, orders and the private events they cause."""
+    import metrics
+    from models import TradesDao
+    from price_cache import PriceCache
+    from replay import INSTRUMENT_INFO, ReplayWebsocket, SimulatedExchange
+    from strategy import Strategy
+    from websocket_streams import WebsocketStreams
+
+    trades_dao = TradesDao()
+    websocket = ReplayWebsocket()
+    exchange = SimulatedExchange(websocket)
+    strategy = Strategy(trades_dao, PriceCache(), exchange)
+    strategy.account_state.reconcile(strategy.exchange_client, [trade["symbol"] for trade in trades_dao.list_items()])
+    streams = WebsocketStreams(strategy.price_cache, trades_dao, strategy.trigger_engine, strategy.account_state, websocket, strategy.order_router)
+    streams.start_price_listener()
+    streams.start_position_listener()
+    prices = [base_price(index) for index in range(symbols)]
+    messages = []
+    for _ in range(ticks):
+        index = rng.randrange(symbols)
+        prices[index] *= 1 + rng.gauss(0, 0.002)
+        messages.append((index, {"topic": "instrument_info.100ms.%s" % symbol_name(index), "data": {"symbol": symbol_name(index), "last_price": "%.4f" % prices[index]}}))
+
+    # Time spent inside the simulated exchange is reported separately, since production does not pay it
+    exchange_seconds = 0.0
+    start = perf_counter()
+    for index, message in messages:
+        websocket.dispatch(INSTRUMENT_INFO, message)
+        exchange_start = perf_counter()
+        exchange.on_price(symbol_name(index), float(message["data"]["last_price"]))
+        exchange_seconds += perf_counter() - exchange_start
+        websocket.drain()
+    dispatched = perf_counter() - start
+    while not strategy.order_executor.is_idle() or not websocket.events.empty() or not streams.is_idle():
+        websocket.drain()
+        sleep(0.001)
+    elapsed = perf_counter() - start
+    return {
+        "ticks": ticks,
+        "ticks_per_second": ticks / elapsed,
+        "ticks_per_second_excluding_exchange": ticks / max(elapsed - exchange_seconds, 1e-9),
+        "dispatch_seconds": dispatched,
+        "exchange_stand_in_seconds": exchange_seconds,
+        "drain_seconds": elapsed - dispatched,
+        "ticks_coalesced": sum(metrics.TICKS_COALESCED.values.values()),
+        "orders_placed": exchange.placed,
+        "tick_handler": histogram_summary(metrics.TICK_HANDLER_SECONDS),
+        "trigger_evaluation": histogram_summary(metrics.TRIGGER_EVALUATION_SECONDS),
+        "trigger_to_order": histogram_summary(metrics.TRIGGER_TO_ORDER_SECONDS),
+        "dao_commit": histogram_summary(metrics.DAO_COMMIT_SECONDS),
+    }
+
+
+def bench_api(symbols: int, rng: random.Random) -> dict:
+    import main
+    from models import TradesDao
+    client = main.app.test_client()
+    headers = {"api_key": os.environ["BOT_API_KEY"]}
+    ids = [trade["id"] for trade in TradesDao().list_items()]
+
+    def new_trade() -> dict:
+        index = rng.randrange(symbols)
+        price = round(base_price(index), 2)
+        return {"symbol": symbol_name(index), "side": "BUY", "quantity": 0.01, "open_conditional_price": price,
+                "trigger_price": round(price * 1.01, 2), "sl_price": round(price * 0.98, 2), "tp_price": round(price * 1.05, 2)}
+
+    routes = {
+        "get_trade": lambda: client.get("/trade/%s" % rng.choice(ids), headers=headers),
+        "post_trade": lambda: client.post("/trade", json=new_trade(), headers=headers),
+        "put_trade": lambda: client.put("/trade/%s" % rng.choice(ids), json={"is_position_open": False}, headers=headers),
+        "list_trades": lambda: client.get("/trade", headers=headers),
+        "metrics": lambda: client.get("/metrics"),
+    }
+    results = {}
+    for name, call in routes.items():
+        samples = []
+        started = perf_counter()
+        while len(samples) < API_REQUESTS and perf_counter() - started < API_SECONDS:
+            start = perf_counter()
+            response = call()
+            samples.append(perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError("%s returned %s: %s" % (name, response.status_code, response.get_data(as_text=True)[:200]))
+        results[name] = summarize(samples)
+        results[name]["requests_per_second"] = len(samples) / (perf_counter() - started)
+    return results
+
+
+def main(args) -> dict:
+    rng = random.Random(args.seed)
+    seed_started = perf_counter()
+    seed_trades(os.environ["TRADES_DB"], args.trades, args.symbols, rng)
+    report = {
+        "meta": {
+            "started_at": time(), "python": platform.python_version(), "platform": platform.platform(),
+            "trades": args.trades, "symbols": args.symbols, "ticks": args.ticks, "seed": args.seed,
+            "seed_seconds": perf_counter() - seed_started,
+        },
+        "results": {},
+    }
+    # The tick benchmark places orders that change trades, so everything that only reads runs before it
+    runs = {
+        "price_cache": lambda: bench_price_cache(args.symbols, args.iterations * 10, rng),
+        "dao": lambda: bench_dao(args.symbols, args.iterations, rng),
+        "trigger_sweep": lambda: bench_trigger_sweep(args.symbols, rng),
+        "ticks": lambda: bench_ticks(args.symbols, args.ticks, rng),
+        "api": lambda: bench_api(args.symbols, rng),
+    }
+    for name in BENCHMARKS:
+        if name in args.only:
+            print("Running %s" % name, file=sys.stderr)
+            report["results"][name] = runs[name]()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark tick handling, trigger sweeps, DAO queries and the API")
+    parser.add_argument("--trades", type=int, default=10000, help="Active trades to seed")
+    parser.add_argument("--symbols", type=int, default=200, help="Symbols the trades are spread across")
+    parser.add_argument("--ticks", type=int, default=50000, help="Price ticks to push through the tick benchmark")
+    parser.add_argument("--iterations", type=int, default=10000, help="Calls per DAO query benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    # Set before the bot's modules are imported, since they read their settings at import time
+    workdir = tempfile.mkdtemp(prefix="tradebot-benchmark-")
+    os.environ["TRADES_DB"] = os.path.join(workdir, "benchmark.db")
+    os.environ["REDIS_MIRROR_ENABLED"] = "False"
+    os.environ["BOT_API_KEY"] = "benchmark"
+    # The simulated exchange has no rate limits, so the client budgets must not throttle the run
+    for limit in ("REST_ORDER_RATE_LIMIT", "REST_CONDITIONAL_QUERY_RATE_LIMIT", "REST_POSITION_RATE_LIMIT"):
+        os.environ[limit] = "1000000000"
+    output = os.path.abspath(args.output) if args.output else None
+    # main.py opens its log file in the working directory
+    os.chdir(workdir)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        report = main(args)
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(workdir, ignore_errors=True)
+    if output is not None:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+from collections import deque
+from time import sleep
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+# Events kept for clients resuming with a cursor. A client further behind than this is sent a fresh snapshot
+CHANGE_FEED_BUFFER_SIZE = int(os.environ.get('CHANGE_FEED_BUFFER_SIZE', 10000))
+# Seconds between price events. Only the latest price of each symbol that changed is sent
+CHANGE_FEED_PRICE_INTERVAL = float(os.environ.get('CHANGE_FEED_PRICE_INTERVAL', 1.0))
+# Each stream holds a server thread for as long as it is open, so keep this below FLASK_THREADS
+CHANGE_FEED_MAX_CLIENTS = int(os.environ.get('CHANGE_FEED_MAX_CLIENTS', 4))
+# Seconds of silence before a comment line is sent to keep idle connections open
+CHANGE_FEED_KEEPALIVE = 15
+
+# (sequence number, event name, JSON data)
+Event = Tuple[int, str, str]
+
+
+class ChangeFeed:
+    """
+    Server-sent event stream of trade row diffs and throttled prices.
+
+    Events go into one sequence-numbered ring buffer and every client reads it from its own cursor. A slow client
+    never blocks producers or other clients. Once it falls out of the buffer it is sent a new snapshot instead of
+    the events it missed. Clients resume by sending the last event ID they saw.
+    """
+
+    def __init__(self, trades: List[dict], prices: Callable[[], Dict[str, float]]):
+        self.prices = prices
+        self.events: Deque[Event] = deque(maxlen=CHANGE_FEED_BUFFER_SIZE)
+        self.sequence = 0
+        # Last published state of each active trade. Diffs are taken against it and snapshots are built from it
+        self.rows: Dict[int, dict] = {trade["id"]: dict(trade) for trade in trades}
+        self.pending_prices: Dict[str, float] = {}
+        self.prices_lock = threading.Lock()
+        self.changed = threading.Condition()
+        self.clients = threading.BoundedSemaphore(CHANGE_FEED_MAX_CLIENTS)
+
+    def on_trade(self, trade: dict):
+        """TradesDao listener. Publishes only the fields that changed since the row was last seen."""
+        trade_id = trade.get("id")
+        if trade_id is None:
+            return
+        with self.changed:
+            previous = self.rows.get(trade_id)
+            if not trade.get("is_active", True):
+                if previous is None:
+                    return
+                del self.rows[trade_id]
+                diff = {"id": trade_id, "is_active": False}
+            else:
+                self.rows[trade_id] = dict(trade)
+                diff = dict(trade) if previous is None else {key: value for key, value in trade.items() if previous.get(key) != value}
+                if previous is not None and len(diff) == 0:
+                    return
+                diff["id"] = trade_id
+            self.__append("trade", diff)
+
+    def on_price(self, symbol: str, price: float):
+        """PriceCache listener. Runs on the tick path, so it only records the price for the next flush."""
+        with self.prices_lock:
+            self.pending_prices[symbol] = price
+
+    def start(self):
+        while True:
+            sleep(CHANGE_FEED_PRICE_INTERVAL)
+            with self.prices_lock:
+                prices, self.pending_prices = self.pending_prices, {}
+            if len(prices) > 0:
+                with self.changed:
+                    self.__append("prices", prices)
+
+    def subscribe(self, cursor: Optional[int]) -> Optional[Iterator[str]]:
+        """Returns the client's event stream, or None when CHANGE_FEED_MAX_CLIENTS streams are already open."""
+        if not self.clients.acquire(blocking=False):
+            return None
+        return self.__stream(cursor)
+
+    def __stream(self, cursor: Optional[int]) -> Iterator[str]:
+        try:
+            while True:
+                with self.changed:
+                    if cursor is None or not self.__can_resume(cursor):
+                        cursor = self.sequence
+                        pending = [(cursor, "snapshot", json.dumps(self.__snapshot()))]
+                    else:
+                        if self.sequence == cursor:
+                            self.changed.wait(CHANGE_FEED_KEEPALIVE)
+                        if not self.__can_resume(cursor):
+                            continue
+                        pending = [event for event in self.events if event[0] > cursor]
+                if len(pending) == 0:
+                    yield ": keepalive\n\n"
+                    continue
+                cursor = pending[-1][0]
+                yield "".join("id: %s\nevent: %s\ndata: %s\n\n" % event for event in pending)
+        finally:
+            self.clients.release()
+
+    def __snapshot(self) -> dict:
+        return {"trades": sorted(self.rows.values(), key=lambda trade: trade["id"]), "prices": self.prices()}
+
+    def __can_resume(self, cursor: int) -> bool:
+        oldest = self.events[0][0] if len(self.events) > 0 else self.sequence + 1
+        return oldest - 1 <= cursor <= self.sequence
+
+    def __append(self, name: str, payload: dict):
+        self.sequence += 1
+        self.events.append((self.sequence, name, json.dumps(payload)))
+        self.changed.notify_all()
@@ -0,0 +1,150 @@
+import logging
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter, sleep, time
+from typing import List, Union
+
+import requests
+from pybit.exceptions import FailedRequestError, InvalidRequestError
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Requests per minute allowed by ByBit for each endpoint class of the USDT perpetual API
+REST_ORDER_RATE_LIMIT = int(os.environ.get('REST_ORDER_RATE_LIMIT', 100))
+REST_CONDITIONAL_QUERY_RATE_LIMIT = int(os.environ.get('REST_CONDITIONAL_QUERY_RATE_LIMIT', 600))
+REST_POSITION_RATE_LIMIT = int(os.environ.get('REST_POSITION_RATE_LIMIT', 120))
+REST_PUBLIC_RATE_LIMIT = 120
+# Share of each budget that background calls (reconciliation, symbol rules) leave for the order path
+REST_BACKGROUND_RESERVE = float(os.environ.get('REST_BACKGROUND_RESERVE', 0.25))
+# Extra attempts for idempotent queries. Order placement is never retried
+REST_MAX_RETRIES = int(os.environ.get('REST_MAX_RETRIES', 3))
+# Upper bound in seconds of the first retry delay. It doubles on each attempt and the actual delay is drawn below it
+REST_RETRY_BASE_DELAY = 0.25
+# Keep-alive HTTPS connections kept open for concurrent order workers and reconciliation
+REST_POOL_SIZE = int(os.environ.get('REST_POOL_SIZE', 16))
+
+RATE_LIMITED = 10006
+# Rate limited, server error and server timeout. Anything else is a problem with the request itself
+RETRYABLE_CODES = {RATE_LIMITED, 10000, 10016}
+
+
+class TokenBucket:
+    """
+    Local copy of one ByBit rate limit. Tokens refill continuously and are corrected down to the remaining
+    count ByBit reports, so bursts wait here instead of being rejected with 10006.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.reserve = self.capacity * REST_BACKGROUND_RESERVE
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, background: bool):
+        floor = self.reserve if background else 0.0
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= floor + 1:
+                        self.tokens -= 1
+                        return
+                    wait = (floor + 1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def update(self, remaining, reset_ms):
+        with self.lock:
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining <= 0 and reset_ms:
+                self.blocked_until = monotonic() + max(0.0, reset_ms / 1000 - time())
+
+    def exhaust(self):
+        with self.lock:
+            self.tokens = 0.0
+
+
+class ExchangeClient:
+    """
+    Wraps the pybit HTTP client, or anything with the same methods, with rate limit budgets and retries.
+
+    Order placement and the checks just before it draw on the whole budget of their endpoint class. Background
+    calls stop at REST_BACKGROUND_RESERVE, so a reconciliation sweep cannot starve an entry. Idempotent queries are
+    retried with jittered exponential backoff, and order placement fails fast.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.orders = TokenBucket(REST_ORDER_RATE_LIMIT)
+        self.conditional_queries = TokenBucket(REST_CONDITIONAL_QUERY_RATE_LIMIT)
+        self.positions = TokenBucket(REST_POSITION_RATE_LIMIT)
+        self.public = TokenBucket(REST_PUBLIC_RATE_LIMIT)
+        session = getattr(client, "client", None)
+        if isinstance(session, requests.Session):
+            # One pool shared by every thread, sized so concurrent calls reuse connections instead of opening new ones
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=REST_POOL_SIZE))
+            # pybit would otherwise sleep through 10006 itself on every call, including order placement
+            client.retry_codes = {10002}
+
+    def place_conditional_order(self, **kwargs) -> dict:
+        return self.__call("place_conditional_order", self.orders, False, False, kwargs)
+
+    def place_conditional_orders(self, orders: List[dict]) -> List[Union[dict, Exception]]:
+        """
+        Places several conditional orders at once, e.g. the levels of a ladder trade. ByBit has no batch endpoint
+        for them, so they go out in parallel over the pooled connections, each drawing on the order budget.
+        Returns each order's response, or the exception it failed with, in the order given.
+        """
+        if len(orders) == 1:
+            # A single order is sent on the calling thread rather than paying for a pool
+            try:
+                return [self.place_conditional_order(**orders[0])]
+            except Exception as e:
+                return [e]
+        with ThreadPoolExecutor(max_workers=max(1, min(len(orders), REST_POOL_SIZE)), thread_name_prefix="bulk-order") as pool:
+            placements = [pool.submit(self.place_conditional_order, **order) for order in orders]
+        return [placement.exception() or placement.result() for placement in placements]
+
+    def query_conditional_order(self, background: bool = False, **kwargs) -> dict:
+        return self.__call("query_conditional_order", self.conditional_queries, True, background, kwargs)
+
+    def my_position(self, background: bool = False, **kwargs) -> dict:
+        return self.__call("my_position", self.positions, True, background, kwargs)
+
+    def query_symbol(self, **kwargs) -> dict:
+        return self.__call("query_symbol", self.public, True, True, kwargs)
+
+    def __call(self, method: str, bucket: TokenBucket, idempotent: bool, background: bool, kwargs: dict) -> dict:
+        attempts = 1 + REST_MAX_RETRIES if idempotent else 1
+        for attempt in range(attempts):
+            start = perf_counter()
+            bucket.acquire(background)
+            metrics.REST_WAIT_SECONDS.observe(perf_counter() - start)
+            try:
+                response = getattr(self.client, method)(**kwargs)
+            except InvalidRequestError as e:
+                if e.status_code == RATE_LIMITED:
+                    bucket.exhaust()
+                if not idempotent or e.status_code not in RETRYABLE_CODES or attempt == attempts - 1:
+                    raise
+                error = e
+            except (FailedRequestError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not idempotent or attempt == attempts - 1:
+                    raise
+                error = e
+            else:
+                if isinstance(response, dict) and response.get("rate_limit_status") is not None:
+                    bucket.update(response["rate_limit_status"], response.get("rate_limit_reset_ms"))
+                return response
+            delay = random.uniform(0, REST_RETRY_BASE_DELAY * 2 ** attempt)
+            metrics.REST_RETRIES.inc(method)
+            logging.warning("Retrying %s in %.2fs after attempt %s failed: %s", method, delay, attempt + 1, error)
+            sleep(delay)
@@ -0,0 +1,97 @@
+import logging
+import os
+from decimal import Decimal
+from time import sleep, time
+from typing import Dict, List, Optional
+
+from pybit.exceptions import FailedRequestError, InvalidRequestError
+
+import metrics
+
+# Seconds between bulk reloads of the symbol rules. Each reload replaces the cache, so delisted symbols drop out
+INSTRUMENT_CACHE_TTL = int(os.environ.get('INSTRUMENT_CACHE_TTL', 3600))
+# Seconds to wait before retrying a reload that failed. The previous rules are kept until one succeeds
+INSTRUMENT_CACHE_RETRY = 60
+
+
+class Instrument:
+    """Trading rules for one symbol. The rounding step sizes are precomputed so the order path only multiplies."""
+
+    __slots__ = ("symbol", "tick_size", "qty_step", "min_qty", "max_qty", "price_decimals", "tick", "step")
+
+    def __init__(self, symbol: str, tick_size: str, qty_step: str, min_qty: str, max_qty: str):
+        self.symbol = symbol
+        self.tick = Decimal(tick_size)
+        self.step = Decimal(qty_step)
+        self.tick_size = float(self.tick)
+        self.qty_step = float(self.step)
+        self.min_qty = float(min_qty)
+        self.max_qty = float(max_qty)
+        self.price_decimals = max(0, -self.tick.normalize().as_tuple().exponent)
+
+    def round_price(self, price: float) -> float:
+        return round(round(price / self.tick_size) * self.tick_size, self.price_decimals)
+
+    def validate(self, quantity, prices: Dict[str, object]) -> List[str]:
+        errors = []
+        if Decimal(str(quantity)) % self.step != 0:
+            errors.append(f"'quantity' must be a multiple of {self.symbol} qty step {self.step}")
+        if not self.min_qty <= float(quantity) <= self.max_qty:
+            errors.append(f"'quantity' must be between {self.min_qty} and {self.max_qty} for {self.symbol}")
+        for name, price in prices.items():
+            if Decimal(str(price)) % self.tick != 0:
+                errors.append(f"'{name}' must be a multiple of {self.symbol} tick size {self.tick}")
+        return errors
+
+
+class InstrumentCache:
+    """
+    Tick size, qty step and quantity limits of every USDT perpetual, loaded with one query_symbol call.
+
+    Lookups are plain dict reads. A background thread reloads the whole table every INSTRUMENT_CACHE_TTL seconds.
+    """
+
+    def __init__(self, exchange_client):
+        self.exchange_client = exchange_client
+        self.instruments: Dict[str, Instrument] = {}
+        self.expires_at = 0.0
+
+    def get(self, symbol: str) -> Optional[Instrument]:
+        return self.instruments.get(str(symbol).upper())
+
+    def load(self) -> bool:
+        try:
+            response = self.exchange_client.query_symbol()
+            instruments = {}
+            for entry in (response or {}).get("result") or []:
+                price_filter = entry["price_filter"]
+                lot_size_filter = entry["lot_size_filter"]
+                instruments[entry["name"]] = Instrument(entry["name"], str(price_filter["tick_size"]), str(lot_size_filter["qty_step"]),
+                                                        str(lot_size_filter["min_trading_qty"]), str(lot_size_filter["max_trading_qty"]))
+        except (FailedRequestError, InvalidRequestError):
+            metrics.REST_ERRORS.inc("query_symbol")
+            logging.exception("Error occurred loading symbol rules from ByBit. Keeping %s cached symbols: ", len(self.instruments))
+            self.expires_at = time() + INSTRUMENT_CACHE_RETRY
+            return False
+        except Exception:
+            logging.exception("Unknown exception occurred loading symbol rules. Keeping %s cached symbols: ", len(self.instruments))
+            self.expires_at = time() + INSTRUMENT_CACHE_RETRY
+            return False
+        self.instruments = instruments
+        self.expires_at = time() + INSTRUMENT_CACHE_TTL
+        logging.info("Loaded symbol rules for %s symbols", len(instruments))
+        return True
+
+    def start(self):
+        while True:
+            sleep(max(0.0, self.expires_at - time()))
+            self.load()
+
+    def validate(self, trade: dict, prices: List[str]) -> List[str]:
+        """Errors for a trade that the exchange would reject. Nothing is checked while no rules are loaded."""
+        if len(self.instruments) == 0:
+            return []
+        instrument = self.get(trade["symbol"])
+        if instrument is None:
+            return [f"'{trade['symbol']}' is not a symbol traded on ByBit"]
+        return instrument.validate(trade["quantity"], {name: trade[name] for name in prices if trade.get(name) is not None})
@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import metrics
+
+# Records waiting for the writer thread. Once full, further records are dropped rather than blocking the caller
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# The log file is rotated at this size, keeping LOG_BACKUP_COUNT old files
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+# Share of private stream messages logged with their raw payload, between 0 (none) and 1 (all)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 0))
+
+# Attributes every LogRecord has. Anything else was passed through `extra` and is written as a field of its own
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per line, with `extra` fields kept as structured values."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": round(record.created, 6), "level": record.levelname, "thread": record.threadName, "msg": record.getMessage()}
+        if record.name != "root":
+            entry["logger"] = record.name
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread as they are. The stock QueueHandler formats the message on the calling
+    thread, so formatting is left to the writer, and a full queue drops the record instead of waiting.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED.inc(record.levelname)
+
+
+def configure_logging(filename: str, level: int = logging.INFO) -> QueueListener:
+    """Routes the root logger through a queue to a rotating JSON lines file written on a background thread."""
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    file_handler = RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(records, file_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    # Handlers inherited from a parent process have no writer thread here, so they are replaced
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(NonBlockingQueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+def log_payload(stream: str, message):
+    """Logs that a private stream message arrived, with the raw payload attached to a sample of them."""
+    if LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logging.info("%s update", stream, extra={"stream": stream, "payload": message})
+    else:
+        logging.info("%s update", stream, extra={"stream": stream})
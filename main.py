@@ -1,42 +1,81 @@
+import json
 import logging
 import os
 import threading
 from functools import wraps
 from pprint import pprint
 from time import sleep
-from typing import List
+from typing import Optional
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, request
 
+import metrics
+from change_feed import ChangeFeed
+from exchange_client import ExchangeClient
+from instruments import InstrumentCache
 from invalid_request import InvalidRequest
+from log_pipeline import configure_logging
 from models import Schema, TradesDao
-from price_cache import PriceCache
-from request_validation import validate_conditional_order_request
+from price_cache import REDIS_MIRROR_ENABLED, PriceCache, RedisPriceMirror
+from request_validation import compile_validators, validate_batch_item, validate_batch_request, validate_conditional_order_request
 from rest_service import RestService
-from strategy import Strategy
-from websocket_streams import WebsocketStreams
+from runtime_snapshot import RUNTIME_SNAPSHOT_PATH, RuntimeSnapshot
+from sharding import BOT_SHARDS, ShardRing, ShardRouter, serve_commands, shard_credentials
+from startup import StartupTimer
+from strategy import BYBIT_EXCHANGE_URL, Strategy
+from websocket_streams import BYBIT_EXCHANGE_DOMAIN, BYBIT_TESTNET_EXCHANGE, RETRIES, WebsocketStreams
 
 FLASK_HOST = os.environ.get('FLASK_HOST', '0.0.0.0')
 FLASK_PORT = os.environ.get('FLASK_PORT', 8888)
+# Inactive trades older than this many days are moved to trades_history once a day. Set to 0 to keep them all
+TRADES_ARCHIVE_AFTER_DAYS = float(os.environ.get('TRADES_ARCHIVE_AFTER_DAYS', 30))
+# "waitress" serves the API on a production WSGI server. "dev" uses the Flask development server
+FLASK_SERVER = os.environ.get('FLASK_SERVER', 'waitress')
+# Request threads for the waitress server
+FLASK_THREADS = int(os.environ.get('FLASK_THREADS', 8))
 
-logging.basicConfig(filename="tradebot.log", level=logging.INFO,
-                    format="%(asctime)s %(levelname)s %(message)s")
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Written as JSON lines by a background thread, so logging on the websocket and order threads never waits on disk
+configure_logging("tradebot.log")
 
 app = Flask(__name__)
+# Set when running as a supervisor, in which case trade calls are routed to the shard worker processes
+shard_router: Optional[ShardRouter] = None
+# Shared by every request. Its DAO reads through a connection pool and writes through TradesWriter
+trade_service: Optional[RestService] = None
+# Pushes trade diffs and prices to /stream clients. Only set when this process runs the bot itself
+change_feed: Optional[ChangeFeed] = None
+# Symbol rules that new trades are validated against, so orders ByBit would reject are refused up front
+instrument_cache: Optional[InstrumentCache] = None
+
+def json_response(payload, status: int = 200) -> Response:
+    # orjson serializes rows several times faster than the standard library when it is installed
+    body = orjson.dumps(payload) if orjson is not None else json.dumps(payload)
+    return Response(body, status=status, mimetype="application/json")
 
-def require_api_key(api_method):
+def require_api_key(api_method, allow_query: bool = False):
     @wraps(api_method)
 
     def check_api_key(*args, **kwargs):
         apikey = request.headers.get("api_key")
+        if apikey is None and allow_query:
+            apikey = request.args.get("api_key")
         if apikey and apikey == os.getenv("BOT_API_KEY"):
             return api_method(*args, **kwargs)
         else:
-            response = jsonify({'message':'Unauthorised'})
-            return response, 401
+            return json_response({'message':'Unauthorised'}, 401)
 
     return check_api_key
 
+def require_api_key_or_query(api_method):
+    # Browser EventSource clients cannot set headers, so they pass the key as ?api_key= instead. Query strings end
+    # up in access logs and browser history, so clients that can send the api_key header should keep doing so
+    return require_api_key(api_method, allow_query=True)
+
 @app.after_request
 def add_headers(response):
     response.headers['Access-Control-Allow-Origin'] = "*"
@@ -48,83 +87,203 @@ def add_headers(response):
 @app.route("/trade", methods=["GET"])
 @require_api_key
 def list_trade():
-    return jsonify(RestService().list())
+    return json_response(rest_service().list())
 
 
 @app.route("/trade", methods=["POST"])
 @require_api_key
 def create_trade():
-    errors = validate_conditional_order_request(request)
+    json_body = request.get_json(silent=True)
+    errors = validate_conditional_order_request(json_body, instrument_cache)
     if errors is not None:
-        print(errors)
         raise InvalidRequest(errors)
-    return jsonify(RestService().create(request.get_json()))
+    return json_response(rest_service().create(json_body))
+
+
+@app.route("/trade/batch", methods=["POST", "PUT", "DELETE"])
+@require_api_key
+def batch_trades():
+    json_body = request.get_json(silent=True)
+    errors = validate_batch_request(request, json_body)
+    if errors is not None:
+        raise InvalidRequest(errors)
+    if request.method == "DELETE":
+        # Results are listed in request order with one entry per trade
+        rows = rest_service().delete_batch(json_body["ids"])
+        return json_response([{"index": index, "trade": row} for index, row in enumerate(rows)])
+    items = json_body["trades"]
+    item_errors = [validate_batch_item(request.method, item, instrument_cache) for item in items]
+    valid = [index for index, errors in enumerate(item_errors) if len(errors) == 0]
+    if request.method == "POST":
+        rows = rest_service().create_batch([items[index] for index in valid])
+    else:
+        rows = rest_service().update_batch([(items[index]["id"], items[index]) for index in valid])
+    results = [{"index": index, "errors": errors} for index, errors in enumerate(item_errors)]
+    for index, row in zip(valid, rows):
+        # Trades the database refused carry their own errors, and the rest of the batch is still applied
+        results[index] = {"index": index, "errors": row["errors"]} if "errors" in row else {"index": index, "trade": row}
+    return json_response(results)
 
 
 @app.route("/trade/<item_id>", methods=["PUT"])
 @require_api_key
 def update_item(item_id):
-    return jsonify(RestService().update(item_id, request.get_json()))
+    return json_response(rest_service().update(item_id, request.get_json()))
 
 @app.route("/trade/<item_id>", methods=["GET"])
 @require_api_key
 def get_item(item_id):
-    return jsonify(RestService().get_by_id(item_id))
+    return json_response(rest_service().get_by_id(item_id))
 
 @app.route("/trade/<item_id>", methods=["DELETE"])
 @require_api_key
 def delete_item(item_id):
-    return jsonify(RestService().delete(item_id))
+    return json_response(rest_service().delete(item_id))
+
+@app.route("/stream", methods=["GET"])
+@require_api_key_or_query
+def stream_changes():
+    """
+    Server-sent events for every trade change. Open it with the api_key header, or from a browser with
+    new EventSource("/stream?api_key=<key>"), which resends Last-Event-ID on reconnect.
+    """
+    if change_feed is None:
+        return json_response({'message': 'Streaming is not available when running with BOT_SHARDS > 1'}, 501)
+    # Browsers resend the last event ID on reconnect. Other clients can pass it as ?cursor=
+    cursor = request.headers.get("Last-Event-ID", request.args.get("cursor"))
+    events = change_feed.subscribe(int(cursor) if cursor is not None and cursor.isdigit() else None)
+    if events is None:
+        return json_response({'message': 'Too many open streams'}, 503)
+    return Response(events, mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Left without an API key so Prometheus can scrape it. It only exposes timings and counts
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @app.errorhandler(InvalidRequest)
 def handle_invalid_usage(error):
-    response = jsonify(error.to_dict())
-    response.status_code = error.status_code
-    return response
+    return json_response(error.to_dict(), error.status_code)
 
 def print_cache(prices: PriceCache):
     while True:
         pprint(prices.read_all_prices())
         sleep(5)
 
-def sync_stream(prices: PriceCache, trade_model: TradesDao, websockets: WebsocketStreams, starting_symbols: List[str]):
-    if starting_symbols is not None and len(starting_symbols) > 0:
-        logging.info("Waiting for prices to load for %s", starting_symbols)
-        for symbol in starting_symbols:
-            while prices.read_price(symbol) is None:
-                sleep(1)
-        logging.info("Prices for %s loaded", starting_symbols)
-        
-    while True:
-        for open_conditional in trade_model.list_items():
-            symbol = open_conditional["symbol"]
-            if prices.read_price(symbol) is None:
-                logging.info("Found new symbol. Subscribing to price stream for %s", symbol)
-                websockets.subscribe(symbol)
-        sleep(10)
+def archive_trades(trade_model: TradesDao):
+    while TRADES_ARCHIVE_AFTER_DAYS > 0:
+        try:
+            archived = trade_model.archive_inactive(TRADES_ARCHIVE_AFTER_DAYS)
+            logging.info("Archived %s inactive trades to history", archived)
+        except Exception:
+            logging.exception("Exception occurred archiving inactive trades: ")
+        sleep(24 * 60 * 60)
 
 
-if __name__ == "__main__":
-    Schema()
-    trades_model = TradesDao()
-    symbols = set(x["symbol"] for x in trades_model.list_items())
+def start_bot(exchange_client=None, websocket=None, archive: bool = True, snapshot_path: str = RUNTIME_SNAPSHOT_PATH, timer: Optional[StartupTimer] = None):
+    """
+    Loads what the trigger books need and returns. Symbol rules and both websocket connections are opened in
+    parallel in the background, so the API is served meanwhile and each symbol triggers from its first tick.
+    """
+    global change_feed, instrument_cache
+    timer = timer if timer is not None else StartupTimer()
+    with timer.phase("trades"):
+        trades_model = TradesDao()
+        symbols = set(x["symbol"] for x in trades_model.list_items())
     if len(symbols) > 0:
         logging.info("Starting bot. Found existing active trades. Will start monitoring symbols: %s", symbols)
     else:
         logging.info("Starting bot. No existing active trades found")
-    price_cache = PriceCache()
-    price_stream = WebsocketStreams(price_cache, trades_model) 
-    price_stream.subscribe_to_price_stream(symbols)
-    price_stream.start_position_listener()
-    
+    price_mirror = RedisPriceMirror() if REDIS_MIRROR_ENABLED else None
+    price_cache = PriceCache(price_mirror)
+    if price_mirror is not None:
+        price_mirror_worker = threading.Thread(target=price_mirror.start)
+        price_mirror_worker.start()
+    with timer.phase("strategy"):
+        strategy = Strategy(trades_model, price_cache, exchange_client)
+    # Until the first load completes, validation is skipped and order prices are rounded by guesswork
+    instrument_cache = strategy.instruments
+    timer.background("instruments", instrument_cache.load, then=instrument_cache.start)
+    # Prices and the account mirror from before a restart, so entry checks and the API need not wait for the exchange.
+    # The account reconciliation below still replaces the mirror as soon as its first REST snapshot completes
+    runtime_snapshot = RuntimeSnapshot(snapshot_path)
+    with timer.phase("runtime_snapshot"):
+        runtime_snapshot.restore(price_cache, strategy.account_state)
+    # Subscribes to prices for the symbols of active trades, then follows trade changes
+    price_stream = WebsocketStreams(price_cache, trades_model, strategy.trigger_engine, strategy.account_state, websocket, strategy.order_router)
+    timer.background("public_stream", price_stream.start_price_listener)
+    timer.background("private_streams", price_stream.start_position_listener)
+
+    change_feed = ChangeFeed(trades_model.list_items(), price_cache.latest_prices)
+    TradesDao.add_listener(change_feed.on_trade)
+    price_cache.add_listener(change_feed.on_price)
+    change_feed_worker = threading.Thread(target=change_feed.start)
+    change_feed_worker.start()
+
+    runtime_snapshot_worker = threading.Thread(target=runtime_snapshot.start, args=(price_cache, price_stream.subscriptions, strategy))
+    runtime_snapshot_worker.start()
+
     print_cache_worker = threading.Thread(target=print_cache, args=(price_cache,))
     print_cache_worker.start()
 
-    sync_stream_worker = threading.Thread(target=sync_stream, args=(price_cache, trades_model, price_stream, symbols))
-    sync_stream_worker.start()
+    reconciliation_worker = threading.Thread(target=strategy.start_reconciliation)
+    reconciliation_worker.start()
+
+    account_reconciliation_worker = threading.Thread(target=strategy.start_account_reconciliation)
+    account_reconciliation_worker.start()
+
+    if archive:
+        archive_worker = threading.Thread(target=archive_trades, args=(trades_model,))
+        archive_worker.start()
 
-    strategy = Strategy(trades_model, price_cache)
-    strategy_worker = threading.Thread(target=strategy.start_strategy)
-    strategy_worker.start()
+def run_shard(shard: int, shards: int, conn):
+    # Runs in a worker process: its own websocket, trigger books and order client for the symbols it owns
+    # Each worker writes and rotates its own log file, since rotation cannot be shared between processes
+    configure_logging("tradebot.%s.log" % shard)
+    from pybit import usdt_perpetual
+    TradesDao.configure_shard(ShardRing(shards).owns(shard))
+    api_key, api_secret = shard_credentials(shard)
+    exchange_client = usdt_perpetual.HTTP(endpoint=BYBIT_EXCHANGE_URL, api_key=api_key, api_secret=api_secret)
+    websocket = usdt_perpetual.WebSocket(test=BYBIT_TESTNET_EXCHANGE, api_key=api_key, api_secret=api_secret, domain=BYBIT_EXCHANGE_DOMAIN, retries=RETRIES)
+    logging.info("Starting shard %s of %s", shard, shards)
+    # Archiving touches every symbol, so only the first shard runs it
+    timer = StartupTimer()
+    start_bot(exchange_client, websocket, archive=shard == 0, snapshot_path="%s.%s" % (RUNTIME_SNAPSHOT_PATH, shard), timer=timer)
+    timer.report("serving commands")
+    serve_commands(conn)
 
-    app.run(host=FLASK_HOST, port=FLASK_PORT)
+def rest_service():
+    global trade_service
+    if shard_router is not None:
+        return shard_router
+    if trade_service is None:
+        trade_service = RestService()
+    return trade_service
+
+
+if __name__ == "__main__":
+    startup_timer = StartupTimer()
+    with startup_timer.phase("schema"):
+        Schema()
+    if BOT_SHARDS > 1:
+        logging.info("Starting supervisor with %s shards", BOT_SHARDS)
+        with startup_timer.phase("shards"):
+            shard_router = ShardRouter(BOT_SHARDS, run_shard)
+            shard_router.start()
+        # The symbol rules are public, so the supervisor loads its own copy to validate requests
+        from pybit import usdt_perpetual
+        instrument_cache = InstrumentCache(ExchangeClient(usdt_perpetual.HTTP(endpoint=BYBIT_EXCHANGE_URL)))
+        startup_timer.background("instruments", instrument_cache.load, then=instrument_cache.start)
+    else:
+        start_bot(timer=startup_timer)
+    # Compiled off the request path, so the first API call does not pay for it. Started only once the shards are
+    # forked, so no child can inherit an import lock held by this thread
+    startup_timer.background("validators", compile_validators)
+    startup_timer.report("serving API")
+
+    if FLASK_SERVER == "waitress":
+        from waitress import serve
+        logging.info("Serving API with waitress on %s:%s with %s threads", FLASK_HOST, FLASK_PORT, FLASK_THREADS)
+        serve(app, host=FLASK_HOST, port=int(FLASK_PORT), threads=FLASK_THREADS)
+    else:
+        app.run(host=FLASK_HOST, port=FLASK_PORT, threaded=True)
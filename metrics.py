@@ -0,0 +1,136 @@
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Upper bounds in seconds. Ticks and index lookups sit in the microsecond range, REST calls in the hundreds of ms
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram. Bucket counts are preallocated, so observing never allocates."""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self) -> List[str]:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %s' % (self.name, bound, cumulative))
+        cumulative += counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %s' % (self.name, cumulative))
+        lines.append("%s_sum %s" % (self.name, total))
+        lines.append("%s_count %s" % (self.name, cumulative))
+        return lines
+
+
+class Counter:
+    """Monotonic counter with a single label, e.g. ticks per symbol."""
+
+    def __init__(self, name: str, documentation: str, label: str):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.values: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: int = 1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values: List[Tuple[str, int]] = sorted(self.values.items())
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        lines.extend('%s{%s="%s"} %s' % (self.name, self.label, value, count) for value, count in values)
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a function at scrape time, so the hot path never updates it."""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.function: Callable[[], float] = lambda: 0
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def render(self) -> List[str]:
+        return ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, self.function())]
+
+
+class LabeledGauge:
+    """Gauge with a single label whose values are set as they become known, e.g. how long each startup phase took."""
+
+    def __init__(self, name: str, documentation: str, label: str):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.values: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def set(self, label_value: str, value: float):
+        with self.lock:
+            self.values[label_value] = value
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values: List[Tuple[str, float]] = sorted(self.values.items())
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s gauge" % self.name]
+        lines.extend('%s{%s="%s"} %s' % (self.name, self.label, label_value, value) for label_value, value in values)
+        return lines
+
+
+TICK_HANDLER_SECONDS = Histogram("bot_tick_handler_seconds", "Time spent handling one instrument_info message")
+TICK_LAG_SECONDS = Histogram("bot_tick_lag_seconds", "Delay between the exchange timestamp of a tick and the bot handling it")
+TRIGGER_EVALUATION_SECONDS = Histogram("bot_trigger_evaluation_seconds", "Time spent evaluating the trigger books for one tick")
+VALID_ENTRY_SECONDS = Histogram("bot_valid_entry_seconds", "Time spent checking for an existing conditional or position")
+PLACE_ORDER_SECONDS = Histogram("bot_place_order_seconds", "Time spent placing one conditional order with ByBit")
+TRIGGER_TO_ORDER_SECONDS = Histogram("bot_trigger_to_order_seconds", "Time from a trade triggering to its conditional order being accepted")
+DAO_QUERY_SECONDS = Histogram("bot_dao_query_seconds", "Time spent answering one query_trades call")
+DAO_COMMIT_SECONDS = Histogram("bot_dao_commit_seconds", "Time spent running and committing one batch of trade writes")
+DAO_BATCH_SIZE = Histogram("bot_dao_batch_size", "Number of trade writes grouped into one transaction", SIZE_BUCKETS)
+REST_WAIT_SECONDS = Histogram("bot_rest_wait_seconds", "Time a REST call waited for rate limit budget before being sent")
+TICKS = Counter("bot_ticks_total", "Price ticks received", "symbol")
+WEBSOCKET_MESSAGES = Counter("bot_websocket_messages_total", "Private stream messages received", "stream")
+REST_ERRORS = Counter("bot_rest_errors_total", "Failed REST calls to ByBit", "operation")
+REST_RETRIES = Counter("bot_rest_retries_total", "REST calls to ByBit retried after a transient failure", "method")
+TICKS_COALESCED = Counter("bot_ticks_coalesced_total", "Ticks replaced by a newer tick before they were handled", "symbol")
+PRIVATE_EVENTS_DROPPED = Counter("bot_private_events_dropped_total", "Private stream messages dropped because the queue was full", "stream")
+LOG_RECORDS_DROPPED = Counter("bot_log_records_dropped_total", "Log records dropped because the log queue was full", "level")
+STARTUP_PHASE_SECONDS = LabeledGauge("bot_startup_phase_seconds", "Seconds each startup phase took to finish", "phase")
+PENDING_TICKS = Gauge("bot_pending_ticks", "Symbols with a tick waiting to be handled")
+PRIVATE_BACKLOG = Gauge("bot_private_backlog", "Private stream messages waiting to be handled")
+
+REGISTRY = [
+    TICK_HANDLER_SECONDS, TICK_LAG_SECONDS, TRIGGER_EVALUATION_SECONDS, VALID_ENTRY_SECONDS, PLACE_ORDER_SECONDS,
+    TRIGGER_TO_ORDER_SECONDS, DAO_QUERY_SECONDS, DAO_COMMIT_SECONDS, DAO_BATCH_SIZE, REST_WAIT_SECONDS, TICKS, WEBSOCKET_MESSAGES,
+    REST_ERRORS, REST_RETRIES, TICKS_COALESCED, PRIVATE_EVENTS_DROPPED, LOG_RECORDS_DROPPED, STARTUP_PHASE_SECONDS,
+    PENDING_TICKS, PRIVATE_BACKLOG,
+]
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -1,17 +1,63 @@
+import json
 import logging
+import os
+import queue
 import sqlite3
-from typing import Dict, List
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import metrics
+from trigger_engine import normalize_side
+
+TRADES_DB = os.environ.get('TRADES_DB', 'trades.db')
+# Most mutations the writer thread will group into a single transaction
+TRADES_WRITER_MAX_BATCH = int(os.environ.get('TRADES_WRITER_MAX_BATCH', 100))
+# Read-only connections shared by the DAOs in a process, for the reads the in-memory index cannot answer
+TRADES_DB_READ_POOL_SIZE = int(os.environ.get('TRADES_DB_READ_POOL_SIZE', 4))
+
+# A write job runs on the writer connection and returns the row ID it touched and the row as it should be published
+WriteJob = Callable[[sqlite3.Connection], Tuple[Optional[int], object]]
 
 
 class Schema:
+    """
+    Creates and migrates trades.db.
+
+    PRAGMA user_version records how many of `migrations` have been applied, and each pending one runs in its
+    own transaction on startup, so existing databases are upgraded in place.
+    """
+
     def __init__(self):
-        self.conn = sqlite3.connect('trades.db', check_same_thread=False)
-        self.create_trades_table()
+        self.conn = sqlite3.connect(TRADES_DB, check_same_thread=False)
+        self.migrations: List[Callable[[], None]] = [
+            self.create_trades_table,
+            self.create_active_trade_indexes,
+            self.create_trades_history_table,
+            self.add_ladder_levels,
+        ]
+        self.migrate()
 
     def __del__(self):
         self.conn.commit()
         self.conn.close()
 
+    def migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(self.migrations[version:], start=version + 1):
+            logging.info("Migrating trades database to version %s: %s", number, migration.__name__)
+            try:
+                self.conn.execute("BEGIN")
+                migration()
+                # PRAGMA cannot take a bound parameter, and number is always an int from enumerate
+                self.conn.execute("PRAGMA user_version=%d" % number)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
     def create_trades_table(self):
 
         query = """
@@ -34,40 +80,394 @@ class Schema:
         """
         c = self.conn.cursor()
         c.execute(query)
-        self.conn.commit()
+
+    def create_active_trade_indexes(self):
+        c = self.conn.cursor()
+        # Rows written before symbols and sides were normalized on insert
+        c.execute("UPDATE trades SET symbol=UPPER(symbol), side=CASE WHEN LOWER(side)='buy' THEN 'Buy' ELSE 'Sell' END")
+        # Partial indexes only cover active rows, so their size tracks open trades rather than the whole history.
+        # Queries must filter on the literal is_active=1 for SQLite to use them
+        c.execute("""
+        CREATE INDEX IF NOT EXISTS "idx_trades_active_symbol_side_quantity"
+        ON "trades" (symbol COLLATE NOCASE, side COLLATE NOCASE, quantity) WHERE is_active=1
+        """)
+        c.execute('CREATE INDEX IF NOT EXISTS "idx_trades_active" ON "trades" (id) WHERE is_active=1')
+
+    def create_trades_history_table(self):
+        c = self.conn.cursor()
+        # Same columns as trades, without AUTOINCREMENT, so archived rows keep their original IDs
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS "trades_history" (
+            id INTEGER PRIMARY KEY,
+            symbol TEXT,
+            side TEXT,
+            quantity REAL,
+            open_conditional_price REAL,
+            trigger_price REAL,
+            sl_price REAL,
+            tp_price REAL,
+            created_at DATETIME,
+            max_sl_count INTEGER,
+            sl_counter INTEGER,
+            is_active BOOLEAN,
+            is_position_open BOOLEAN,
+            is_conditional_open BOOLEAN,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+
+
+    def add_ladder_levels(self):
+        c = self.conn.cursor()
+        # JSON list of [trigger_price, quantity] pairs for ladder trades. NULL for trades with a single entry
+        c.execute('ALTER TABLE "trades" ADD COLUMN levels TEXT')
+        c.execute('ALTER TABLE "trades_history" ADD COLUMN levels TEXT')
+
+
+class TradeIndex:
+    """
+    Active trades held in memory, keyed by id, by (symbol, side) and by (symbol, side, quantity).
+
+    Symbols and sides are matched case-insensitively, the same as the COLLATE NOCASE lookups they replace.
+    Lookups return copies so callers can never mutate the indexed rows. In a shard worker, trades for symbols
+    the shard does not own are never filed.
+    """
+
+    def __init__(self, owns: Optional[Callable[[str], bool]] = None):
+        self.owns = owns
+        self.by_id: Dict[int, dict] = {}
+        self.by_symbol_side: Dict[Tuple[str, str], Dict[int, dict]] = {}
+        self.by_symbol_side_qty: Dict[Tuple[str, str, float], Dict[int, dict]] = {}
+        self.lock = threading.Lock()
+
+    def load(self, trades: List[dict]):
+        with self.lock:
+            self.by_id = {}
+            self.by_symbol_side = {}
+            self.by_symbol_side_qty = {}
+            for trade in trades:
+                self.__add(trade)
+
+    def put(self, trade: dict):
+        """Files an active trade, or drops it from the index once it is no longer active."""
+        trade_id = int(trade["id"])
+        with self.lock:
+            existing = self.by_id.get(trade_id)
+            is_owned = self.owns is None or trade.get("symbol") is None or self.owns(str(trade["symbol"]))
+            if not trade.get("is_active", True) or not is_owned:
+                if existing is not None:
+                    self.__remove(existing)
+                return
+            trade = dict(trade)
+            symbol_side, symbol_side_qty = self.__keys(trade)
+            if existing is not None and self.__keys(existing) == (symbol_side, symbol_side_qty):
+                # Keys are unchanged, so replace in place and keep each bucket in id order
+                self.by_id[trade_id] = trade
+                self.by_symbol_side[symbol_side][trade_id] = trade
+                self.by_symbol_side_qty[symbol_side_qty][trade_id] = trade
+                return
+            if existing is not None:
+                self.__remove(existing)
+            self.__add(trade)
+
+    def get(self, trade_id: int) -> Optional[dict]:
+        trade = self.by_id.get(trade_id)
+        return None if trade is None else dict(trade)
+
+    def list(self) -> List[Dict]:
+        with self.lock:
+            return [dict(trade) for trade in self.by_id.values()]
+
+    def query(self, symbol: str = None, side: str = None, qty: float = None) -> List[Dict]:
+        with self.lock:
+            if symbol and side and qty:
+                matches = self.by_symbol_side_qty.get((symbol.upper(), side.lower(), float(qty)), {}).values()
+            elif symbol and side:
+                matches = self.by_symbol_side.get((symbol.upper(), side.lower()), {}).values()
+            else:
+                # No caller looks up without both symbol and side, so these combinations filter every active trade
+                matches = [trade for trade in self.by_id.values()
+                           if (not symbol or str(trade["symbol"]).upper() == symbol.upper())
+                           and (not side or str(trade["side"]).lower() == side.lower())
+                           and (not qty or float(trade["quantity"]) == float(qty))]
+            return [dict(trade) for trade in matches]
+
+    def __add(self, trade: dict):
+        trade_id = int(trade["id"])
+        symbol_side, symbol_side_qty = self.__keys(trade)
+        self.by_id[trade_id] = trade
+        self.by_symbol_side.setdefault(symbol_side, {})[trade_id] = trade
+        self.by_symbol_side_qty.setdefault(symbol_side_qty, {})[trade_id] = trade
+
+    def __remove(self, trade: dict):
+        trade_id = int(trade["id"])
+        symbol_side, symbol_side_qty = self.__keys(trade)
+        self.by_id.pop(trade_id, None)
+        for index, key in ((self.by_symbol_side, symbol_side), (self.by_symbol_side_qty, symbol_side_qty)):
+            bucket = index.get(key)
+            if bucket is None:
+                continue
+            bucket.pop(trade_id, None)
+            if len(bucket) == 0:
+                del index[key]
+
+    @staticmethod
+    def __keys(trade: dict) -> Tuple[Tuple[str, str], Tuple[str, str, float]]:
+        symbol = str(trade["symbol"]).upper()
+        side = str(trade["side"]).lower()
+        qty = float(trade["quantity"]) if trade["quantity"] is not None else 0.0
+        return (symbol, side), (symbol, side, qty)
+
+
+class ConnectionPool:
+    """Fixed set of SQLite connections handed out one thread at a time, so readers never share a cursor."""
+
+    def __init__(self, database: str, size: int):
+        self.connections: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(max(1, size)):
+            conn = sqlite3.connect(database, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self.connections.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            # Reads never open a transaction, so the connection goes back clean
+            self.connections.put(conn)
+
+
+class TradesWriter:
+    """
+    Owns the only connection that writes to trades.db, on a dedicated thread.
+
+    Jobs queued while a transaction is running are grouped into the next one, so a burst of websocket updates
+    costs one commit instead of one per statement. Each job gets a Future that resolves to its updated row once
+    the batch is committed and `on_commit` has published it. Jobs submitted together with `submit_batch` succeed
+    or fail as a unit and resolve to the list of their rows.
+    """
+
+    def __init__(self, database: str, on_commit: Callable[[int, dict], None]):
+        self.conn = sqlite3.connect(database, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps the database consistent on power loss with NORMAL, and only the last commits are at risk
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.on_commit = on_commit
+        # (jobs, future, whether the future resolves to a list of rows)
+        self.jobs: "queue.Queue[Tuple[List[WriteJob], Future, bool]]" = queue.Queue()
+        self.worker = threading.Thread(target=self.start, name="trades-writer", daemon=True)
+        self.worker.start()
+
+    def submit(self, job: WriteJob) -> Future:
+        future = Future()
+        self.jobs.put(([job], future, False))
+        return future
+
+    def submit_batch(self, jobs: List[WriteJob]) -> Future:
+        future = Future()
+        self.jobs.put((jobs, future, True))
+        return future
+
+    def start(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < TRADES_WRITER_MAX_BATCH:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            start = perf_counter()
+            try:
+                results = [[job(self.conn) for job in jobs] for jobs, _, _ in batch]
+                self.conn.commit()
+                metrics.DAO_COMMIT_SECONDS.observe(perf_counter() - start)
+                metrics.DAO_BATCH_SIZE.observe(sum(len(jobs) for jobs, _, _ in batch))
+            except Exception:
+                # Roll the whole batch back and retry each submission in its own transaction so one bad write fails alone
+                self.conn.rollback()
+                if len(batch) > 1:
+                    logging.warning("Exception occurred writing batch of %s trade updates. Retrying individually", len(batch))
+                for jobs, future, is_batch in batch:
+                    self.__run_single(jobs, future, is_batch)
+                continue
+            for (_, future, is_batch), rows in zip(batch, results):
+                self.__publish(future, rows, is_batch)
+
+    def __run_single(self, jobs: List[WriteJob], future: Future, is_batch: bool):
+        try:
+            rows = [job(self.conn) for job in jobs]
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logging.exception("Exception occurred writing trade update: ")
+            future.set_exception(e)
+            return
+        self.__publish(future, rows, is_batch)
+
+    def __publish(self, future: Future, rows: List[Tuple[Optional[int], object]], is_batch: bool):
+        try:
+            for row_id, row in rows:
+                # Jobs that do not touch a single trade, such as archiving, return no row ID and publish nothing
+                if row_id is not None:
+                    self.on_commit(row_id, row)
+        finally:
+            future.set_result([row for _, row in rows] if is_batch else rows[0][1])
 
 
 class TradesDao:
+    """
+    Trades persisted in SQLite, with active trades served from a shared in-memory TradeIndex.
+
+    Every write is queued to the shared TradesWriter and the fresh row is then written through to the index,
+    so reads of active trades never touch disk. The `*_async` variants return the writer's Future instead of
+    waiting for the commit.
+    """
+    # Shared across DAO instances so writes made through any connection (e.g. the REST API) reach the listeners
+    listeners: List[Callable[[dict], None]] = []
+    index: Optional[TradeIndex] = None
+    writer: Optional[TradesWriter] = None
+    readers: Optional[ConnectionPool] = None
+    init_lock = threading.Lock()
+    # Set in shard worker processes so only trades for the shard's own symbols are loaded
+    owns: Optional[Callable[[str], bool]] = None
 
     def __init__(self):
-        self.conn = sqlite3.connect('trades.db', check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        with TradesDao.init_lock:
+            if TradesDao.readers is None:
+                TradesDao.readers = ConnectionPool(TRADES_DB, TRADES_DB_READ_POOL_SIZE)
+            if TradesDao.index is None:
+                index = TradeIndex(TradesDao.owns)
+                index.load(self.__select_active())
+                TradesDao.index = index
+            if TradesDao.writer is None:
+                TradesDao.writer = TradesWriter(TRADES_DB, TradesDao.__notify)
 
-    def __del__(self):
-        self.conn.commit()
-        self.conn.close()
+    @classmethod
+    def add_listener(cls, listener: Callable[[dict], None]):
+        cls.listeners.append(listener)
+
+    @staticmethod
+    def __notify(row_id, trade: dict):
+        # An empty result means the row is no longer active, so the index and listeners are told to drop it
+        change = trade if len(trade) > 0 else {"id": int(row_id), "is_active": False}
+        owns = TradesDao.owns
+        if owns is not None and change.get("symbol") is not None and not owns(str(change["symbol"])):
+            # Another shard's trade, e.g. written through the shared database. Its own worker handles it
+            return
+        TradesDao.index.put(change)
+        for listener in TradesDao.listeners:
+            try:
+                listener(change)
+            except Exception:
+                logging.exception("Exception occurred notifying trade listener for row ID %s: ", row_id)
 
     def get_by_id(self, row_id, is_active: bool = True) -> dict:
-        c = self.conn.cursor()
-        trades = c.execute("SELECT * FROM trades WHERE is_active=? and id=? LIMIT 1", (int(is_active), row_id,)).fetchall()
-        self.conn.commit()
-        result = {} if trades is None or len(trades) == 0 else trades[0]
-        return dict(result)
+        if is_active:
+            try:
+                trade = TradesDao.index.get(int(row_id))
+            except (TypeError, ValueError):
+                return {}
+            return {} if trade is None else trade
+        with TradesDao.readers.connection() as conn:
+            result = select_by_id(conn, row_id, is_active)
+            if len(result) == 0:
+                rows = conn.execute("SELECT * FROM trades_history WHERE id=? LIMIT 1", (row_id,)).fetchall()
+                result = {} if len(rows) == 0 else to_trade(rows[0])
+            return result
+
+    @classmethod
+    def configure_shard(cls, owns: Callable[[str], bool]):
+        cls.owns = owns
+
+    def __select_active(self) -> List[Dict]:
+        with TradesDao.readers.connection() as conn:
+            result_set = conn.execute("SELECT * FROM trades WHERE is_active=1 ORDER BY id").fetchall()
+        owns = TradesDao.owns
+        return [to_trade(row) for row in result_set if owns is None or owns(row["symbol"])]
 
     def create(self, params) -> dict:
-        trade = (params.get("symbol"), params.get("side"), params.get("quantity"), params.get("open_conditional_price"), params.get("trigger_price"), params.get("sl_price"), params.get("tp_price"), params.get("max_sl_count", 1))
-        c = self.conn.cursor()
-        insert_result = c.execute('insert into trades (symbol, side, quantity, open_conditional_price, trigger_price, sl_price, tp_price, max_sl_count) values (?,?,?,?,?,?,?,?)', trade)
-        self.conn.commit()
-        return self.get_by_id(insert_result.lastrowid)
+        return self.create_async(params).result()
+
+    def create_async(self, params) -> Future:
+        return TradesDao.writer.submit(self.__create_job(params))
+
+    def create_batch(self, params_list: List[dict]) -> List[dict]:
+        """Creates every trade in one transaction. Trades the database refuses come back as {"errors": [...]}."""
+        return self.__write_batch([self.__create_job(params) for params in params_list])
+
+    def __create_job(self, params) -> WriteJob:
+        # Stored as Bybit reports them (e.g. BTCUSDT, Buy) so lookups never depend on the caller's casing
+        symbol = None if params.get("symbol") is None else str(params.get("symbol")).upper()
+        side = None if params.get("side") is None else normalize_side(params.get("side"))
+        quantity, trigger_price, levels = params.get("quantity"), params.get("trigger_price"), None
+        if params.get("levels"):
+            # A ladder is stored as one row: the first level's trigger price, the total quantity and every level as JSON
+            ladder = [[float(level["trigger_price"]), float(level["quantity"])] for level in params["levels"]]
+            trigger_price, quantity = ladder[0][0], sum(level[1] for level in ladder)
+            levels = json.dumps(ladder, separators=(",", ":"))
+        trade = (symbol, side, quantity, params.get("open_conditional_price"), trigger_price, params.get("sl_price"), params.get("tp_price"), params.get("max_sl_count", 1), levels)
+
+        def insert(conn: sqlite3.Connection) -> Tuple[int, dict]:
+            insert_result = conn.execute('insert into trades (symbol, side, quantity, open_conditional_price, trigger_price, sl_price, tp_price, max_sl_count, levels) values (?,?,?,?,?,?,?,?,?)', trade)
+            return insert_result.lastrowid, select_by_id(conn, insert_result.lastrowid)
+        return insert
 
     def update(self, row_id, params: dict) -> dict:
+        future = self.update_async(row_id, params)
+        return {} if future is None else future.result()
+
+    def update_async(self, row_id, params: dict) -> Optional[Future]:
+        job = self.__update_job(row_id, params)
+        return None if job is None else TradesDao.writer.submit(job)
+
+    def update_batch(self, updates: List[Tuple[int, dict]]) -> List[dict]:
+        """
+        Applies (row ID, params) updates in one transaction. Updates with nothing to change come back empty, and
+        updates the database refuses come back as {"errors": [...]}.
+        """
+        jobs = [self.__update_job(row_id, params) for row_id, params in updates]
+        rows = iter(self.__write_batch([job for job in jobs if job is not None]))
+        return [{} if job is None else next(rows) for job in jobs]
+
+    def __write_batch(self, jobs: List[WriteJob]) -> List[dict]:
+        # One transaction for the whole batch. If it fails, each job is retried in its own so only the bad ones fail
+        try:
+            return TradesDao.writer.submit_batch(jobs).result()
+        except Exception:
+            logging.warning("Exception occurred writing batch of %s trades. Retrying individually", len(jobs))
+        futures = [TradesDao.writer.submit(job) for job in jobs]
+        rows = []
+        for future in futures:
+            try:
+                rows.append(future.result())
+            except Exception as e:
+                rows.append({"errors": [str(e)]})
+        return rows
+
+    def set_position_open_async(self, flags: Dict[int, bool]) -> Optional[Future]:
+        """
+        Queues is_position_open flags as one transaction without waiting. Each flag is compared in the UPDATE
+        itself, so a flag that is already set is neither written nor published, even if the earlier write that
+        set it was still queued when the caller looked. Returns None when there is nothing to queue.
+        """
+        def flag_job(row_id: int, is_open: bool) -> WriteJob:
+            def set_flag(conn: sqlite3.Connection) -> Tuple[Optional[int], dict]:
+                changed = conn.execute("UPDATE trades SET is_position_open=? WHERE id=? AND is_position_open!=?", (is_open, row_id, is_open)).rowcount
+                return (row_id, select_by_id(conn, row_id)) if changed > 0 else (None, {})
+            return set_flag
+        jobs = [flag_job(row_id, is_open) for row_id, is_open in flags.items()]
+        return None if len(jobs) == 0 else TradesDao.writer.submit_batch(jobs)
+
+    def __update_job(self, row_id, params: dict) -> Optional[WriteJob]:
         if row_id is None:
             logging.warning("No row ID provided to update function. Nothing to update for params: %s", params)
-            return {}
+            return None
         if params is None or len(params) == 0:
             logging.warning("No params passed to update function. Nothing to updated. Row ID: %s", row_id)
-            return {}
+            return None
         set_query = ""
         update_tuple = ()
         separator = ""
@@ -79,62 +479,85 @@ class TradesDao:
             set_query = set_query + separator + " is_position_open=?"
             update_tuple = update_tuple + (params.get("is_position_open"),)
             separator = ","
-        if params.get("is_sl_hit") is not None:
-            set_query = set_query + separator + " is_sl_hit=?"
-            update_tuple = update_tuple + (params.get("is_sl_hit"),)
-            separator = ","
         if params.get("is_conditional_open") is not None:
             set_query = set_query + separator + " is_conditional_open=?"
             update_tuple = update_tuple + (params.get("is_conditional_open"),)
             separator = ","
         if len(update_tuple) == 0:
             logging.warning("Invalid params passed to update function. Nothing to updated. Row ID: %s", row_id)
-            return {}
+            return None
         query = "UPDATE trades SET" + set_query + " WHERE id=?"
         update_tuple = update_tuple + (row_id,)
-        c = self.conn.cursor()
-        c.execute(query, update_tuple)
-        self.conn.commit()
-        return self.get_by_id(row_id)
+
+        def update(conn: sqlite3.Connection) -> Tuple[int, dict]:
+            conn.execute(query, update_tuple)
+            return row_id, select_by_id(conn, row_id)
+        return update
 
     def deactivate_trade(self, row_id) -> dict:
-        c = self.conn.cursor()
-        c.execute("UPDATE trades SET is_active=? WHERE id=?", (0, row_id))
-        self.conn.commit()
-        return self.get_by_id(row_id, False)
+        return self.deactivate_trade_async(row_id).result()
+
+    def deactivate_trade_async(self, row_id) -> Future:
+        return TradesDao.writer.submit(self.__deactivate_job(row_id))
+
+    def deactivate_batch(self, row_ids: List[int]) -> List[dict]:
+        return TradesDao.writer.submit_batch([self.__deactivate_job(row_id) for row_id in row_ids]).result()
+
+    def __deactivate_job(self, row_id) -> WriteJob:
+        def deactivate(conn: sqlite3.Connection) -> Tuple[int, dict]:
+            conn.execute("UPDATE trades SET is_active=? WHERE id=?", (0, row_id))
+            return row_id, select_by_id(conn, row_id, False)
+        return deactivate
 
     def increment_sl_counter(self, row_id) -> dict:
-        c = self.conn.cursor()
-        c.execute("UPDATE trades SET sl_counter=sl_counter+1 WHERE id=?", (row_id,))
-        self.conn.commit()
-        result = self.get_by_id(row_id)
-        return result
+        def increment(conn: sqlite3.Connection) -> Tuple[int, dict]:
+            conn.execute("UPDATE trades SET sl_counter=sl_counter+1 WHERE id=?", (row_id,))
+            return row_id, select_by_id(conn, row_id)
+        return TradesDao.writer.submit(increment).result()
+
+    def apply_order_fills(self, stop_losses: Dict[int, int], closed: List[int]) -> List[dict]:
+        """
+        Applies the fills of one order stream message in one transaction. `stop_losses` maps trade IDs to the
+        number of stop losses they hit, and trades reaching max_sl_count are deactivated in the same statement.
+        Trades in `closed` were closed out some other way and are deactivated. Returns the updated rows.
+        """
+        def stop_loss_job(row_id: int, hits: int) -> WriteJob:
+            def stop_loss(conn: sqlite3.Connection) -> Tuple[int, dict]:
+                conn.execute("UPDATE trades SET sl_counter=sl_counter+?, is_active=CASE WHEN sl_counter+? >= max_sl_count THEN 0 ELSE is_active END WHERE id=?", (hits, hits, row_id))
+                return row_id, select_by_id(conn, row_id) or select_by_id(conn, row_id, False)
+            return stop_loss
+        jobs = [stop_loss_job(row_id, hits) for row_id, hits in stop_losses.items() if row_id not in closed]
+        jobs.extend(self.__deactivate_job(row_id) for row_id in closed)
+        return [] if len(jobs) == 0 else TradesDao.writer.submit_batch(jobs).result()
+
+    def archive_inactive(self, older_than_days: float) -> int:
+        """Moves inactive trades created more than `older_than_days` ago into trades_history. Returns how many moved."""
+        cutoff = "-%s days" % float(older_than_days)
+
+        def archive(conn: sqlite3.Connection) -> Tuple[None, int]:
+            columns = "id, symbol, side, quantity, open_conditional_price, trigger_price, sl_price, tp_price, created_at, max_sl_count, sl_counter, is_active, is_position_open, is_conditional_open, levels"
+            where = "is_active=0 AND created_at < datetime('now', ?)"
+            conn.execute("INSERT OR REPLACE INTO trades_history (" + columns + ") SELECT " + columns + " FROM trades WHERE " + where, (cutoff,))
+            return None, conn.execute("DELETE FROM trades WHERE " + where, (cutoff,)).rowcount
+        return TradesDao.writer.submit(archive).result()
 
     def list_items(self) -> List[Dict]:
-        c = self.conn.cursor()
-        result_set = c.execute("SELECT * FROM trades WHERE is_active=?", (1,)).fetchall()
-        self.conn.commit()
-        result = [{column: row[i]
-                  for i, column in enumerate(result_set[0].keys())}
-                  for row in result_set]
-        return result
-    
+        return TradesDao.index.list()
+
     def query_trades(self, symbol: str = None, side: str = None, qty: float = None) -> List[Dict]:
-        c = self.conn.cursor()
-        query_tuple = (1,)
-        query = "SELECT * FROM trades WHERE is_active=?"
-        if symbol:
-            query = query + " and symbol=? COLLATE NOCASE"
-            query_tuple = query_tuple + (symbol,)
-        if side:
-            query = query + " and side=? COLLATE NOCASE"
-            query_tuple = query_tuple + (side,)
-        if qty:
-            query = query + " and quantity=?"
-            query_tuple = query_tuple + (qty,)
-        query_result = c.execute(query, query_tuple).fetchall()
-        self.conn.commit()
-        result = [{column: row[i]
-                  for i, column in enumerate(query_result[0].keys())}
-                  for row in query_result]
+        start = perf_counter()
+        result = TradesDao.index.query(symbol, side, qty)
+        metrics.DAO_QUERY_SECONDS.observe(perf_counter() - start)
         return result
+
+
+def select_by_id(conn: sqlite3.Connection, row_id, is_active: bool = True) -> dict:
+    trades = conn.execute("SELECT * FROM trades WHERE is_active=? and id=? LIMIT 1", (int(is_active), row_id,)).fetchall()
+    return {} if trades is None or len(trades) == 0 else to_trade(trades[0])
+
+
+def to_trade(row: sqlite3.Row) -> dict:
+    trade = dict(row)
+    if trade.get("levels") is not None:
+        trade["levels"] = json.loads(trade["levels"])
+    return trade
@@ -0,0 +1,76 @@
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Set, Tuple
+
+# Upper bound on concurrent order submissions across all symbols. Each submission makes up to three REST calls
+ORDER_EXECUTOR_MAX_WORKERS = int(os.environ.get('ORDER_EXECUTOR_MAX_WORKERS', 4))
+
+
+class OrderExecutor:
+    """
+    Runs order submissions on a bounded worker pool.
+
+    Jobs for the same symbol run one at a time and in submission order, so duplicate pre-checks and placements
+    on one symbol can never interleave, while different symbols proceed in parallel up to the global cap.
+    A key that is already queued or running is rejected, so one trade is never submitted twice concurrently.
+    """
+
+    def __init__(self, max_workers: int = ORDER_EXECUTOR_MAX_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="order")
+        self.queues: Dict[str, Deque[Tuple[Hashable, Callable[[], Any], Optional[Callable[[Any], None]]]]] = {}
+        self.in_flight: Set[Hashable] = set()
+        self.lock = threading.Lock()
+
+    def submit(self, symbol: str, key: Hashable, job: Callable[[], Any], then: Optional[Callable[[Any], None]] = None) -> bool:
+        """
+        Queues `job` unless `key` is already queued or running. `then` is called with the job's result, or None if
+        it raised, once the key is released, so it may submit the same key again.
+        """
+        with self.lock:
+            if key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+            symbol_queue = self.queues.get(symbol)
+            if symbol_queue is not None:
+                # A worker is already draining this symbol and will pick the job up next
+                symbol_queue.append((key, job, then))
+                return True
+            self.queues[symbol] = deque([(key, job, then)])
+        self.pool.submit(self.__drain, symbol)
+        return True
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        return key in self.in_flight
+
+    def is_idle(self) -> bool:
+        # A symbol's queue is dropped only after its last job and follow-up have finished
+        with self.lock:
+            return len(self.queues) == 0
+
+    def shutdown(self, wait: bool = True):
+        self.pool.shutdown(wait=wait)
+
+    def __drain(self, symbol: str):
+        while True:
+            with self.lock:
+                symbol_queue = self.queues[symbol]
+                if len(symbol_queue) == 0:
+                    del self.queues[symbol]
+                    return
+                key, job, then = symbol_queue.popleft()
+            result = None
+            try:
+                result = job()
+            except Exception:
+                logging.exception("Exception occurred running order job %s for %s: ", key, symbol)
+            finally:
+                with self.lock:
+                    self.in_flight.discard(key)
+            if then is not None:
+                try:
+                    then(result)
+                except Exception:
+                    logging.exception("Exception occurred following up order job %s for %s: ", key, symbol)
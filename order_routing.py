@@ -0,0 +1,92 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from trigger_engine import normalize_side
+
+# Order link IDs and handled exchange events remembered for routing and deduplication. Older entries are forgotten
+ORDER_ROUTER_HISTORY = int(os.environ.get('ORDER_ROUTER_HISTORY', 10000))
+LINK_PREFIX = "conditional_"
+
+
+class OrderRouter:
+    """
+    Routes private stream events straight to the trades they belong to.
+
+    Strategy registers every order_link_id with its trade ID before the order is sent. When that entry order
+    fills, the trade is recorded as a holder of the position on its symbol and side. Stop loss and take profit
+    orders are created by the exchange without an order_link_id, and are routed to the holders of the position
+    they close. Handled events are remembered by exchange order ID and status, so a message pybit redelivers is
+    not applied twice, and stop losses by order ID alone, so one that fills in parts counts once.
+    """
+
+    def __init__(self):
+        self.links: "OrderedDict[str, int]" = OrderedDict()
+        self.holders: Dict[Tuple[str, str], Set[int]] = {}
+        self.seen: "OrderedDict[Tuple[str, str, Optional[str]], None]" = OrderedDict()
+        # Untriggered conditional orders per trade, so a ladder stays open until the last of its levels triggers
+        self.open_conditionals: Dict[int, Set[str]] = {}
+        self.lock = threading.Lock()
+
+    def register(self, order_link_id: str, trade_id: int):
+        with self.lock:
+            self.links[order_link_id] = int(trade_id)
+            if len(self.links) > ORDER_ROUTER_HISTORY:
+                self.links.popitem(last=False)
+
+    def trade_for_link(self, order_link_id: Optional[str]) -> Optional[int]:
+        if not order_link_id:
+            return None
+        with self.lock:
+            trade_id = self.links.get(order_link_id)
+        if trade_id is not None:
+            return trade_id
+        # Orders placed before a restart, or long enough ago to be forgotten, still carry the trade ID in the link
+        parts = str(order_link_id).split("_")
+        if str(order_link_id).startswith(LINK_PREFIX) and len(parts) > 1 and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def is_duplicate(self, stream: str, event_id: Optional[str], status: Optional[str] = None) -> bool:
+        """
+        Records the event and returns True when it has been handled before. Without a status, any earlier event for
+        the same ID counts. Events without an ID are never duplicates.
+        """
+        if not event_id:
+            return False
+        key = (stream, event_id, status)
+        with self.lock:
+            if key in self.seen:
+                return True
+            self.seen[key] = None
+            if len(self.seen) > ORDER_ROUTER_HISTORY:
+                self.seen.popitem(last=False)
+            return False
+
+    def conditional_update(self, trade_id: int, order_link_id: str, is_open: bool) -> bool:
+        """Records whether one conditional order of the trade is untriggered. Returns whether any of them still are."""
+        with self.lock:
+            open_links = self.open_conditionals.setdefault(trade_id, set())
+            if is_open:
+                open_links.add(order_link_id)
+            else:
+                open_links.discard(order_link_id)
+            if len(open_links) == 0:
+                del self.open_conditionals[trade_id]
+                return False
+            return True
+
+    def add_holder(self, symbol: str, side: str, trade_id: int):
+        with self.lock:
+            self.holders.setdefault((symbol.upper(), normalize_side(side)), set()).add(trade_id)
+
+    def holders_of(self, symbol: str, side: str) -> Optional[List[int]]:
+        """Trades whose entry fills opened the position, or None when none were seen, e.g. since a restart."""
+        with self.lock:
+            holders = self.holders.get((symbol.upper(), normalize_side(side)))
+            return None if holders is None else sorted(holders)
+
+    def clear_holders(self, symbol: str, side: str):
+        with self.lock:
+            self.holders.pop((symbol.upper(), normalize_side(side)), None)
@@ -1,22 +1,109 @@
+import itertools
+import logging
 import os
-from typing import Dict, List, Optional
-
-import redis
+import threading
+from time import sleep
+from typing import Callable, Dict, List, Optional, Tuple
 
 REDIS_HOST = os.environ.get('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = os.environ.get('REDIS_PORT', 6379)
+# Redis only mirrors prices for external consumers. The bot reads from the in-memory cache
+REDIS_MIRROR_ENABLED = bool(os.environ.get('REDIS_MIRROR_ENABLED', 'False').lower() in ('true',))
+# Seconds between write-behind flushes to Redis
+REDIS_MIRROR_INTERVAL = float(os.environ.get('REDIS_MIRROR_INTERVAL', 0.5))
+# Hash holding symbol -> price. A second hash with the ":timestamp" suffix holds the exchange timestamps
+REDIS_PRICES_KEY = os.environ.get('REDIS_PRICES_KEY', 'prices')
+
+# (price, exchange timestamp in seconds, sequence number)
+PriceEntry = Tuple[float, Optional[float], int]
 
-class PriceCache:
+
+class RedisPriceMirror:
+    """
+    Write-behind copy of the latest prices in Redis.
+
+    Ticks are coalesced in memory and flushed on an interval as pipelined HSETs into dedicated hashes,
+    so a flush costs one round trip however many symbols changed.
+    """
 
     def __init__(self):
+        import redis
         self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-        self.redis.flushall()
-    
-    def upsert_price(self, symbol: str, price: float):
-        return self.redis.set(symbol, price)
-    
+        self.pending: Dict[str, PriceEntry] = {}
+        self.lock = threading.Lock()
+
+    def publish(self, symbol: str, entry: PriceEntry):
+        with self.lock:
+            self.pending[symbol] = entry
+
+    def start(self):
+        while True:
+            sleep(REDIS_MIRROR_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if len(pending) == 0:
+            return
+        timestamps = {symbol: entry[1] for symbol, entry in pending.items() if entry[1] is not None}
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hset(REDIS_PRICES_KEY, mapping={symbol: entry[0] for symbol, entry in pending.items()})
+            if len(timestamps) > 0:
+                pipe.hset(REDIS_PRICES_KEY + ":timestamp", mapping=timestamps)
+            pipe.execute()
+        except Exception:
+            logging.exception("Exception occurred mirroring %s prices to Redis: ", len(pending))
+
+    def read_prices(self, symbols: List[str]) -> Dict[str, Optional[float]]:
+        if len(symbols) == 0:
+            return {}
+        values = self.redis.hmget(REDIS_PRICES_KEY, symbols)
+        return {symbol: None if value is None else float(value) for symbol, value in zip(symbols, values)}
+
+    def read_all_prices(self) -> Dict[str, float]:
+        return {symbol: float(value) for symbol, value in self.redis.hgetall(REDIS_PRICES_KEY).items()}
+
+
+class PriceCache:
+    """
+    Latest price per symbol, held in process memory.
+
+    Writes replace a whole tuple in a dict, which is atomic under the GIL, so readers never take a lock.
+    """
+
+    def __init__(self, mirror: Optional[RedisPriceMirror] = None):
+        self.prices: Dict[str, PriceEntry] = {}
+        self.sequence = itertools.count(1)
+        self.mirror = mirror
+        self.listeners: List[Callable[[str, float], None]] = []
+
+    def add_listener(self, listener: Callable[[str, float], None]):
+        self.listeners.append(listener)
+
+    def upsert_price(self, symbol: str, price: float, timestamp: Optional[float] = None) -> PriceEntry:
+        entry = (float(price), timestamp, next(self.sequence))
+        self.prices[symbol] = entry
+        if self.mirror is not None:
+            self.mirror.publish(symbol, entry)
+        for listener in self.listeners:
+            listener(symbol, entry[0])
+        return entry
+
     def read_price(self, symbol: str) -> Optional[float]:
-        return self.redis.get(symbol)
+        entry = self.prices.get(symbol)
+        return None if entry is None else entry[0]
+
+    def read_prices(self, symbols: List[str]) -> Dict[str, Optional[float]]:
+        prices = self.prices
+        return {symbol: None if symbol not in prices else prices[symbol][0] for symbol in symbols}
+
+    def read_entry(self, symbol: str) -> Optional[PriceEntry]:
+        return self.prices.get(symbol)
+
+    def latest_prices(self) -> Dict[str, float]:
+        return {symbol: entry[0] for symbol, entry in self.prices.copy().items()}
 
     def read_all_prices(self) -> List[Dict]:
-        return [{key: self.redis.get(key)} for key in self.redis.keys('*')]
+        return [{symbol: entry[0]} for symbol, entry in self.prices.copy().items()]
@@ -0,0 +1,319 @@
+"""
+Offline replay of recorded Bybit feeds through WebsocketStreams and Strategy.
+
+A feed is a gzip-compressed JSON lines file where each line is {"t": seconds, "stream": name, "message": {...}}
+and `stream` is one of instrument_info, order, stop_order or position. `message` is exactly what pybit handed
+to the stream callback. Orders placed by the bot go to SimulatedExchange, which fills them against the replayed
+prices and answers with the private stream events Bybit would send.
+
+    python replay.py record feed.jsonl.gz --symbols BTCUSDT ETHUSDT
+    python replay.py run feed.jsonl.gz --speed 0 --trades trades.json --db replay.db
+
+A speed of 0 replays as fast as possible. Replays run against their own database (replay.db by default), which is
+seeded from --trades, a JSON list of trade request bodies.
+"""
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from time import perf_counter, sleep, time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from trigger_engine import normalize_side
+
+INSTRUMENT_INFO = "instrument_info"
+ORDER = "order"
+STOP_ORDER = "stop_order"
+POSITION = "position"
+
+
+def read_feed(path: str) -> Iterator[dict]:
+    with gzip.open(path, "rt") as feed:
+        for line in feed:
+            if line.strip():
+                yield json.loads(line)
+
+
+class FeedRecorder:
+    """Appends every message from a live pybit WebSocket to a feed file."""
+
+    def __init__(self, path: str):
+        self.feed = gzip.open(path, "at")
+        self.lock = threading.Lock()
+
+    def callback(self, stream: str) -> Callable[[dict], None]:
+        def record(message: dict):
+            line = json.dumps({"t": time(), "stream": stream, "message": message})
+            with self.lock:
+                self.feed.write(line + "\n")
+        return record
+
+    def close(self):
+        with self.lock:
+            self.feed.close()
+
+
+class ReplayWebsocket:
+    """
+    Stands in for the pybit WebSocket. Callbacks are registered the same way, and messages are dispatched on the
+    replay thread only, so handlers see one message at a time just as they do on the live connection.
+    """
+
+    def __init__(self):
+        self.price_callbacks: Dict[str, Callable[[dict], None]] = {}
+        self.callbacks: Dict[str, Callable[[dict], None]] = {}
+        self.events: "queue.Queue[Tuple[str, dict]]" = queue.Queue()
+
+    def instrument_info_stream(self, callback: Callable[[dict], None], symbol):
+        for name in [symbol] if isinstance(symbol, str) else symbol:
+            self.price_callbacks[name.upper()] = callback
+
+    def position_stream(self, callback: Callable[[dict], None]):
+        self.callbacks[POSITION] = callback
+
+    def stop_order_stream(self, callback: Callable[[dict], None]):
+        self.callbacks[STOP_ORDER] = callback
+
+    def order_stream(self, callback: Callable[[dict], None]):
+        self.callbacks[ORDER] = callback
+
+    def emit(self, stream: str, data: List[dict]):
+        # Safe from any thread. Events wait until the replay thread drains them
+        self.events.put((stream, {"topic": stream, "data": data}))
+
+    def dispatch(self, stream: str, message: dict):
+        if stream == INSTRUMENT_INFO:
+            callback = self.price_callbacks.get(str(message["data"]["symbol"]).upper())
+        else:
+            callback = self.callbacks.get(stream)
+        if callback is not None:
+            callback(message)
+
+    def drain(self):
+        while True:
+            try:
+                stream, message = self.events.get_nowait()
+            except queue.Empty:
+                return
+            self.dispatch(stream, message)
+
+
+class SimulatedExchange:
+    """
+    Just enough of the pybit HTTP client for Strategy: conditional orders trigger against replayed prices and fill
+    immediately, positions close at their stop loss or take profit, and each step emits the matching private events.
+    """
+
+    def __init__(self, websocket: ReplayWebsocket):
+        self.websocket = websocket
+        self.conditionals: Dict[str, dict] = {}
+        self.positions: Dict[Tuple[str, str], dict] = {}
+        self.order_ids = itertools.count(1)
+        self.placed = 0
+        self.lock = threading.Lock()
+
+    def place_conditional_order(self, symbol: str, side: str, qty: float, base_price: float, stop_px: float, stop_loss: float = None, take_profit: float = None, order_link_id: str = "", **kwargs) -> dict:
+        order = {
+            "stop_order_id": "sim-%s" % next(self.order_ids), "order_link_id": order_link_id, "symbol": symbol.upper(),
+            "side": normalize_side(side), "qty": float(qty), "trigger_price": float(stop_px), "base_price": float(base_price),
+            "stop_loss": stop_loss, "take_profit": take_profit, "order_status": "Untriggered", "create_type": "CreateByUser",
+            "cancel_type": "UNKNOWN",
+        }
+        with self.lock:
+            self.conditionals[order["stop_order_id"]] = order
+            self.placed += 1
+        self.websocket.emit(STOP_ORDER, [dict(order)])
+        return {"ret_code": 0, "result": dict(order)}
+
+    def query_symbol(self, **kwargs) -> dict:
+        # No symbol rules, so Strategy falls back to guessing the rounding precision
+        return {"ret_code": 0, "result": []}
+
+    def query_conditional_order(self, symbol: str, **kwargs) -> dict:
+        with self.lock:
+            return {"ret_code": 0, "result": [dict(order) for order in self.conditionals.values() if order["symbol"] == symbol.upper()]}
+
+    def my_position(self, symbol: str = None, **kwargs) -> dict:
+        with self.lock:
+            positions = [self.__position(key) for key in self.positions if symbol is None or key[0] == symbol.upper()]
+        # Like Bybit, a single-symbol query returns bare positions and the account-wide one wraps each in "data"
+        return {"ret_code": 0, "result": positions if symbol is not None else [{"data": position, "is_valid": True} for position in positions]}
+
+    def on_price(self, symbol: str, price: float):
+        symbol = symbol.upper()
+        with self.lock:
+            triggered = [order for order in self.conditionals.values() if order["symbol"] == symbol and self.__is_triggered(order, price)]
+            for order in triggered:
+                del self.conditionals[order["stop_order_id"]]
+            closed = [key for key, position in self.positions.items() if key[0] == symbol and position["size"] > 0 and self.__close_type(key[1], position, price)]
+        for order in triggered:
+            self.__fill(order, price)
+        for key in closed:
+            self.__close(key, price)
+
+    def __fill(self, order: dict, price: float):
+        key = (order["symbol"], order["side"])
+        order = dict(order, order_status="Triggered")
+        self.websocket.emit(STOP_ORDER, [order])
+        self.websocket.emit(ORDER, [self.__order(order["symbol"], order["side"], order["qty"], price, "CreateByUser", order["order_link_id"])])
+        with self.lock:
+            position = self.positions.setdefault(key, {"size": 0.0, "entry_price": price, "stop_loss": None, "take_profit": None})
+            position["size"] += order["qty"]
+            position["entry_price"] = price
+            position["stop_loss"] = order["stop_loss"]
+            position["take_profit"] = order["take_profit"]
+            snapshot = self.__position(key)
+        self.websocket.emit(POSITION, [snapshot])
+
+    def __close(self, key: Tuple[str, str], price: float):
+        with self.lock:
+            position = self.positions[key]
+            create_type = self.__close_type(key[1], position, price)
+            if create_type is None:
+                return
+            qty = position["size"]
+            position["size"] = 0.0
+            snapshot = self.__position(key)
+        closing_side = "Sell" if key[1] == "Buy" else "Buy"
+        self.websocket.emit(ORDER, [self.__order(key[0], closing_side, qty, price, create_type, "")])
+        self.websocket.emit(POSITION, [snapshot])
+
+    def __position(self, key: Tuple[str, str]) -> dict:
+        position = self.positions[key]
+        return {"symbol": key[0], "side": key[1], "size": position["size"], "entry_price": position["entry_price"],
+                "stop_loss": position["stop_loss"], "take_profit": position["take_profit"]}
+
+    @staticmethod
+    def __is_triggered(order: dict, price: float) -> bool:
+        # The trigger direction follows from which side of stop_px the base price was placed
+        if order["base_price"] < order["trigger_price"]:
+            return price >= order["trigger_price"]
+        return price <= order["trigger_price"]
+
+    @staticmethod
+    def __close_type(side: str, position: dict, price: float) -> Optional[str]:
+        stop_loss, take_profit = position["stop_loss"], position["take_profit"]
+        if side == "Buy":
+            if stop_loss is not None and price <= float(stop_loss):
+                return "CreateByStopLoss"
+            if take_profit is not None and price >= float(take_profit):
+                return "CreateByTakeProfit"
+        else:
+            if stop_loss is not None and price >= float(stop_loss):
+                return "CreateByStopLoss"
+            if take_profit is not None and price <= float(take_profit):
+                return "CreateByTakeProfit"
+        return None
+
+    def __order(self, symbol: str, side: str, qty: float, price: float, create_type: str, order_link_id: str) -> dict:
+        return {"order_id": "sim-order-%s" % next(self.order_ids), "symbol": symbol, "side": side, "qty": qty, "price": price,
+                "last_exec_price": price, "cum_exec_qty": qty, "order_status": "Filled", "create_type": create_type,
+                "order_link_id": order_link_id}
+
+
+def settle(websocket: ReplayWebsocket, streams, strategy):
+    """Dispatches simulated exchange events until the streams and the order executor have nothing left to do."""
+    while not strategy.order_executor.is_idle() or not websocket.events.empty() or not streams.is_idle():
+        websocket.drain()
+        sleep(0)
+
+
+def run(feed_path: str, speed: float, trades_path: Optional[str]):
+    # Imported here so TRADES_DB is set before models reads it
+    import metrics
+    from models import Schema, TradesDao
+    from price_cache import PriceCache
+    from strategy import Strategy
+    from websocket_streams import WebsocketStreams
+
+    Schema()
+    trades_dao = TradesDao()
+    if trades_path is not None:
+        with open(trades_path) as trades_file:
+            for params in json.load(trades_file):
+                trades_dao.create(params)
+    websocket = ReplayWebsocket()
+    exchange = SimulatedExchange(websocket)
+    strategy = Strategy(trades_dao, PriceCache(), exchange)
+    strategy.account_state.reconcile(strategy.exchange_client, [trade["symbol"] for trade in trades_dao.list_items()])
+    streams = WebsocketStreams(strategy.price_cache, trades_dao, strategy.trigger_engine, strategy.account_state, websocket, strategy.order_router)
+    streams.start_price_listener()
+    streams.start_position_listener()
+
+    ticks = 0
+    first_t = None
+    start = perf_counter()
+    for record in read_feed(feed_path):
+        stream, message = record["stream"], record["message"]
+        if speed > 0:
+            first_t = record["t"] if first_t is None else first_t
+            delay = (record["t"] - first_t) / speed - (perf_counter() - start)
+            if delay > 0:
+                sleep(delay)
+        websocket.dispatch(stream, message)
+        # Ticks are handled on the streams' own worker threads. Waiting for them, and for the orders they trigger,
+        # before the next record keeps replays of the same feed identical
+        settle(websocket, streams, strategy)
+        if stream == INSTRUMENT_INFO:
+            ticks += 1
+            exchange.on_price(str(message["data"]["symbol"]).upper(), float(message["data"]["last_price"]))
+            settle(websocket, streams, strategy)
+    elapsed = perf_counter() - start
+
+    latency = metrics.TRIGGER_TO_ORDER_SECONDS
+    print("Ticks replayed: %s in %.3fs (%.0f ticks/s)" % (ticks, elapsed, ticks / elapsed if elapsed > 0 else 0))
+    print("Ticks coalesced before handling: %s" % sum(metrics.TICKS_COALESCED.values.values()))
+    print("Conditional orders placed: %s" % exchange.placed)
+    if sum(latency.counts) > 0:
+        print("Mean trigger to order latency: %.6fs" % (latency.sum / sum(latency.counts)))
+    print("Active trades remaining: %s" % len(trades_dao.list_items()))
+
+
+def record(feed_path: str, symbols: List[str]):
+    from pybit import usdt_perpetual
+    from websocket_streams import BYBIT_API_KEY, BYBIT_API_SECRET, BYBIT_EXCHANGE_DOMAIN, BYBIT_TESTNET_EXCHANGE, RETRIES
+
+    recorder = FeedRecorder(feed_path)
+    websocket = usdt_perpetual.WebSocket(test=BYBIT_TESTNET_EXCHANGE, api_key=BYBIT_API_KEY, api_secret=BYBIT_API_SECRET, domain=BYBIT_EXCHANGE_DOMAIN, retries=RETRIES)
+    for symbol in symbols:
+        websocket.instrument_info_stream(recorder.callback(INSTRUMENT_INFO), symbol)
+    websocket.position_stream(recorder.callback(POSITION))
+    websocket.stop_order_stream(recorder.callback(STOP_ORDER))
+    websocket.order_stream(recorder.callback(ORDER))
+    print("Recording %s to %s. Press Ctrl+C to stop" % (symbols, feed_path))
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        recorder.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record live Bybit feeds or replay them through the bot offline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="Record live price and private streams to a feed file")
+    record_parser.add_argument("feed")
+    record_parser.add_argument("--symbols", nargs="+", required=True)
+    run_parser = commands.add_parser("run", help="Replay a feed file through WebsocketStreams and Strategy")
+    run_parser.add_argument("feed")
+    run_parser.add_argument("--speed", type=float, default=0, help="Replay speed multiplier. 0 replays as fast as possible")
+    run_parser.add_argument("--trades", help="JSON list of trades to create before replaying")
+    run_parser.add_argument("--db", default="replay.db", help="SQLite database for the replay. Never point this at the live trades.db")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seed for generated order link IDs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "record":
+        record(args.feed, args.symbols)
+    else:
+        os.environ["TRADES_DB"] = args.db
+        # SimulatedExchange has no rate limits, so the client budgets must not throttle the replay
+        for limit in ("REST_ORDER_RATE_LIMIT", "REST_CONDITIONAL_QUERY_RATE_LIMIT", "REST_POSITION_RATE_LIMIT"):
+            os.environ[limit] = "1000000000"
+        random.seed(args.seed)
+        run(args.feed, args.speed, args.trades)
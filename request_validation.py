@@ -1,8 +1,4 @@
-from json import loads
-from urllib.request import Request
-
-from flask_inputs import Inputs
-from flask_inputs.validators import JsonSchema
+from functools import lru_cache
 
 SYMBOL = "symbol"
 SIDE = "side"
@@ -12,6 +8,11 @@ TRIGGER_PRICE = "trigger_price"
 SL_PRICE = "sl_price"
 TP_PRICE = "tp_price"
 MAX_SL_COUNT = "max_sl_count"
+LEVELS = "levels"
+# Prices placed on the conditional order, which ByBit rejects when they are off the symbol's tick size
+EXCHANGE_PRICES = [TRIGGER_PRICE, SL_PRICE, TP_PRICE]
+# Largest number of levels in one ladder trade. Each level is placed as its own conditional order
+MAX_LADDER_LEVELS = 50
 
 create_conditional_order_schema = {
     'type': 'object',
@@ -40,38 +41,130 @@ create_conditional_order_schema = {
         MAX_SL_COUNT: {
             'type': 'number'
         },
+        # A ladder scales into the position at several trigger prices, all armed by the same open_conditional_price
+        LEVELS: {
+            'type': 'array',
+            'minItems': 1,
+            'maxItems': MAX_LADDER_LEVELS,
+            'items': {
+                'type': 'object',
+                'properties': {
+                    TRIGGER_PRICE: {'type': 'number'},
+                    QUANTITY: {'type': 'number'},
+                },
+                'required': [TRIGGER_PRICE, QUANTITY]
+            }
+        },
+    },
+    'required': [SYMBOL, SIDE, OPEN_CONDITIONAL_PRICE, SL_PRICE],
+    # Without levels the trade has a single entry, given by its own quantity and trigger price
+    'if': {'not': {'required': [LEVELS]}},
+    'then': {'required': [QUANTITY, TRIGGER_PRICE]}
+}
+
+# Largest number of trades accepted by one batch request
+MAX_BATCH_SIZE = 500
+
+update_trade_schema = {
+    'type': 'object',
+    'properties': {
+        'id': {
+            'type': 'integer'
+        },
+        'is_active': {
+            'type': 'boolean'
+        },
+        'is_position_open': {
+            'type': 'boolean'
+        },
+        'is_conditional_open': {
+            'type': 'boolean'
+        },
     },
-    'required': [SYMBOL, SIDE, QUANTITY, OPEN_CONDITIONAL_PRICE, TRIGGER_PRICE, SL_PRICE]
+    'required': ['id'],
+    # Anything else is a typo or a column that cannot be updated, so the trade is refused rather than half applied
+    'additionalProperties': False
 }
 
-class CreateConditionalInputs(Inputs):
-    create_conditional_schema = JsonSchema(schema=create_conditional_order_schema)
-    json = [create_conditional_schema]
-
-    def validate(self):
-        is_valid = super().validate()
-        if is_valid:
-            request: Request = self._request
-            json_body = loads(request.data)
-            side = json_body[SIDE]
-                
-            if side == "BUY":
-                if float(json_body[OPEN_CONDITIONAL_PRICE]) > float(json_body[TRIGGER_PRICE]):
-                    is_valid = False
-                    self.errors.append(f"When '{SIDE}' is BUY, '{OPEN_CONDITIONAL_PRICE}' must be less than '{TRIGGER_PRICE}'")
-            elif side == "SELL":
-                if float(json_body[OPEN_CONDITIONAL_PRICE]) < float(json_body[TRIGGER_PRICE]):
-                    is_valid = False
-                    self.errors.append(f"When '{SIDE}' is SELL, '{OPEN_CONDITIONAL_PRICE}' must be greater than '{TRIGGER_PRICE}'")
-            else:
-                is_valid = False
-                self.errors.append(f"'{SIDE}' must be one of BUY or SELL'")
-        return is_valid
-
-def validate_conditional_order_request(request):
-   inputs = CreateConditionalInputs(request)
-   if inputs.validate():
-       return None
-   else:
-       print(len(inputs.errors))
-       return inputs.errors
+# Each trade is validated on its own with validate_batch_item, so one bad trade does not reject the batch
+batch_trades_schema = {
+    'type': 'object',
+    'properties': {
+        'trades': {'type': 'array', 'minItems': 1, 'maxItems': MAX_BATCH_SIZE, 'items': {'type': 'object'}}
+    },
+    'required': ['trades']
+}
+
+batch_delete_schema = {
+    'type': 'object',
+    'properties': {
+        'ids': {'type': 'array', 'minItems': 1, 'maxItems': MAX_BATCH_SIZE, 'items': {'type': 'integer'}}
+    },
+    'required': ['ids']
+}
+
+
+@lru_cache(maxsize=None)
+def compile_validators() -> dict:
+    """
+    Compiled once, on first use, so validating a batch does not rebuild the schema for every item. jsonschema is
+    imported here rather than at module load, since it is among the slowest imports of the bot.
+    """
+    from jsonschema import Draft7Validator
+    return {
+        'create': Draft7Validator(create_conditional_order_schema),
+        'update': Draft7Validator(update_trade_schema),
+        'POST': Draft7Validator(batch_trades_schema),
+        'PUT': Draft7Validator(batch_trades_schema),
+        'DELETE': Draft7Validator(batch_delete_schema),
+    }
+
+
+def level_entries(json_body) -> list:
+    """The body as one trade per conditional order: the trade itself, or a copy per ladder level."""
+    if json_body.get(LEVELS) is None:
+        return [json_body]
+    return [dict(json_body, **{TRIGGER_PRICE: level[TRIGGER_PRICE], QUANTITY: level[QUANTITY]}) for level in json_body[LEVELS]]
+
+
+def validate_side_prices(json_body) -> list:
+    errors = []
+    side = json_body[SIDE]
+    if side == "BUY":
+        if any(float(json_body[OPEN_CONDITIONAL_PRICE]) > float(entry[TRIGGER_PRICE]) for entry in level_entries(json_body)):
+            errors.append(f"When '{SIDE}' is BUY, '{OPEN_CONDITIONAL_PRICE}' must be less than '{TRIGGER_PRICE}'")
+    elif side == "SELL":
+        if any(float(json_body[OPEN_CONDITIONAL_PRICE]) < float(entry[TRIGGER_PRICE]) for entry in level_entries(json_body)):
+            errors.append(f"When '{SIDE}' is SELL, '{OPEN_CONDITIONAL_PRICE}' must be greater than '{TRIGGER_PRICE}'")
+    else:
+        errors.append(f"'{SIDE}' must be one of BUY or SELL'")
+    return errors
+
+
+def validate_conditional_order_request(json_body, instruments=None):
+    """
+    Validates an already parsed create body. Returns None when valid, otherwise the list of errors.
+    With an InstrumentCache the quantity and the prices sent to ByBit are also checked against the symbol's rules.
+    Ladder trades are checked level by level, so a ladder is accepted or refused as a whole.
+    """
+    if json_body is None:
+        return ["Request body must be JSON"]
+    errors = [error.message for error in compile_validators()['create'].iter_errors(json_body)]
+    if len(errors) == 0:
+        errors = validate_side_prices(json_body)
+    if len(errors) == 0 and instruments is not None:
+        errors = [error for entry in level_entries(json_body) for error in instruments.validate(entry, EXCHANGE_PRICES)]
+    return None if len(errors) == 0 else errors
+
+def validate_batch_request(request, json_body):
+    """Checks the envelope of a batch request. Returns None when valid, otherwise the list of errors."""
+    if json_body is None:
+        return ["Request body must be JSON"]
+    errors = [error.message for error in compile_validators()[request.method].iter_errors(json_body)]
+    return None if len(errors) == 0 else errors
+
+def validate_batch_item(method: str, item, instruments=None) -> list:
+    """Errors for one trade in a batch, so the rest of the batch can still be applied."""
+    if method == 'POST':
+        return validate_conditional_order_request(item, instruments) or []
+    return [error.message for error in compile_validators()['update'].iter_errors(item)]
@@ -14,6 +14,15 @@ class RestService:
     def delete(self, item_id):
         return self.model.deactivate_trade(item_id)
 
+    def create_batch(self, params_list):
+        return self.model.create_batch(params_list)
+
+    def update_batch(self, updates):
+        return self.model.update_batch(updates)
+
+    def delete_batch(self, item_ids):
+        return self.model.deactivate_batch(item_ids)
+
     def list(self):
         response = self.model.list_items()
         return response
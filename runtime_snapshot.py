@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+from time import sleep, time
+from typing import Optional
+
+from account_state import AccountState
+from price_cache import PriceCache
+
+# Where the runtime state is written. Shard workers append their shard number
+RUNTIME_SNAPSHOT_PATH = os.environ.get('RUNTIME_SNAPSHOT_PATH', 'runtime_snapshot.json')
+# Seconds between snapshots. Set to 0 to disable them
+RUNTIME_SNAPSHOT_INTERVAL = float(os.environ.get('RUNTIME_SNAPSHOT_INTERVAL', 5))
+# Snapshots older than this many seconds are ignored at startup, since their prices would be too stale to show
+RUNTIME_SNAPSHOT_MAX_AGE = float(os.environ.get('RUNTIME_SNAPSHOT_MAX_AGE', 300))
+
+
+class RuntimeSnapshot:
+    """
+    Periodic copy of the state that is otherwise rebuilt from the exchange after a restart: last prices, the
+    subscribed symbols, the account state mirror and orders that were sent but not yet acknowledged.
+
+    Each snapshot replaces the previous one atomically, so a crash mid-write leaves the last complete one behind.
+    """
+
+    def __init__(self, path: str = RUNTIME_SNAPSHOT_PATH):
+        self.path = path
+
+    def restore(self, price_cache: PriceCache, account_state: AccountState) -> Optional[dict]:
+        """Seeds prices and the account state mirror. Returns the snapshot, or None when there is no usable one."""
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                snapshot = json.loads(snapshot_file.read())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logging.exception("Exception occurred reading runtime snapshot %s. Starting cold: ", self.path)
+            return None
+        age = time() - snapshot["written_at"]
+        if age > RUNTIME_SNAPSHOT_MAX_AGE:
+            logging.info("Ignoring runtime snapshot written %.0fs ago", age)
+            return None
+        # Prices of symbols that were no longer subscribed had stopped updating well before the snapshot
+        subscribed = set(snapshot["subscriptions"])
+        restored = 0
+        for symbol, (price, timestamp) in snapshot["prices"].items():
+            if symbol in subscribed and price_cache.read_entry(symbol) is None:
+                price_cache.upsert_price(symbol, price, timestamp)
+                restored += 1
+        account_state.restore(snapshot["account"])
+        for order_id, (symbol, side, qty, trigger_price) in snapshot["pending_orders"].items():
+            account_state.add_conditional(order_id, symbol, side, qty, trigger_price)
+        logging.info("Restored runtime snapshot written %.1fs ago with %s prices and %s pending orders", age, restored, len(snapshot["pending_orders"]))
+        return snapshot
+
+    def start(self, price_cache: PriceCache, subscriptions, strategy):
+        while RUNTIME_SNAPSHOT_INTERVAL > 0:
+            sleep(RUNTIME_SNAPSHOT_INTERVAL)
+            try:
+                self.write(price_cache, subscriptions, strategy)
+            except Exception:
+                logging.exception("Exception occurred writing runtime snapshot %s: ", self.path)
+
+    def write(self, price_cache: PriceCache, subscriptions, strategy):
+        snapshot = {
+            "written_at": time(),
+            "prices": {symbol: [entry[0], entry[1]] for symbol, entry in price_cache.prices.copy().items()},
+            "subscriptions": sorted(subscriptions.wanted),
+            "account": strategy.account_state.to_snapshot(),
+            "pending_orders": {order_id: list(conditional) for order_id, conditional in strategy.pending_orders.copy().items()},
+        }
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file, separators=(",", ":"))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.path)
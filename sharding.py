@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+from bisect import bisect_right
+from multiprocessing.connection import Connection
+from typing import Callable, Dict, List, Optional, Tuple
+
+from models import TRADES_DB
+from rest_service import RestService
+
+# Worker processes to partition symbols across. 1 runs everything in a single process as before
+BOT_SHARDS = int(os.environ.get('BOT_SHARDS', 1))
+# Points per shard on the hash ring. More points even out how many symbols each shard owns
+SHARD_VIRTUAL_NODES = 64
+
+
+class ShardRing:
+    """Consistent hash of symbols onto shards, so changing the shard count only moves a fraction of the symbols."""
+
+    def __init__(self, shards: int, virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        self.shards = shards
+        points = sorted((self.__hash("%s:%s" % (shard, node)), shard) for shard in range(shards) for node in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [shard for _, shard in points]
+
+    def shard_for(self, symbol: str) -> int:
+        index = bisect_right(self.hashes, self.__hash(str(symbol).upper())) % len(self.hashes)
+        return self.owners[index]
+
+    def owns(self, shard: int) -> Callable[[str], bool]:
+        return lambda symbol: self.shard_for(symbol) == shard
+
+    @staticmethod
+    def __hash(value: str) -> int:
+        # Python's hash() is salted per process, and every process has to agree on the owner
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+def shard_credentials(shard: int) -> Tuple[Optional[str], Optional[str]]:
+    """A shard can trade a separate (sub)account through BYBIT_API_KEY_<n> and BYBIT_API_SECRET_<n>."""
+    return os.getenv("BYBIT_API_KEY_%s" % shard, os.getenv("BYBIT_API_KEY")), os.getenv("BYBIT_API_SECRET_%s" % shard, os.getenv("BYBIT_API_SECRET"))
+
+
+def serve_commands(conn: Connection):
+    """Answers RestService calls sent by the supervisor's ShardRouter, one at a time."""
+    service = RestService()
+    while True:
+        try:
+            method, args = conn.recv()
+        except EOFError:
+            logging.info("Supervisor closed the command channel")
+            return
+        try:
+            conn.send(("ok", getattr(service, method)(*args)))
+        except Exception as e:
+            logging.exception("Exception occurred handling %s command from supervisor: ", method)
+            conn.send(("error", str(e)))
+
+
+class ShardWorker:
+
+    def __init__(self, shard: int, shards: int, target: Callable[[int, int, Connection], None]):
+        self.shard = shard
+        self.conn, worker_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=target, args=(shard, shards, worker_conn), name="shard-%s" % shard, daemon=True)
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process.start()
+
+    def call(self, method: str, *args):
+        # Flask serves requests on several threads, but each pipe carries one request and reply at a time
+        with self.lock:
+            self.conn.send((method, args))
+            status, result = self.conn.recv()
+        if status != "ok":
+            raise RuntimeError("Shard %s failed to %s: %s" % (self.shard, method, result))
+        return result
+
+
+class ShardRouter:
+    """
+    Drop-in for RestService in the supervisor process. Each call is sent over a pipe to the worker process that
+    owns the trade's symbol. Calls that only carry a trade ID look its symbol up in the shared database first.
+    """
+
+    def __init__(self, shards: int, target: Callable[[int, int, Connection], None]):
+        self.ring = ShardRing(shards)
+        self.workers: Dict[int, ShardWorker] = {shard: ShardWorker(shard, shards, target) for shard in range(shards)}
+        self.conn = sqlite3.connect(TRADES_DB, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+
+    def create(self, params):
+        return self.__worker_for(params.get("symbol")).call("create", params)
+
+    def update(self, item_id, params):
+        worker = self.__worker_for_id(item_id)
+        return {} if worker is None else worker.call("update", item_id, params)
+
+    def delete(self, item_id):
+        worker = self.__worker_for_id(item_id)
+        return {} if worker is None else worker.call("delete", item_id)
+
+    def create_batch(self, params_list: List[dict]) -> List[dict]:
+        # One transaction per shard. Results are put back in request order
+        return self.__scatter("create_batch", [(self.ring.shard_for(params.get("symbol")), params) for params in params_list])
+
+    def update_batch(self, updates: List[Tuple[int, dict]]) -> List[dict]:
+        return self.__scatter("update_batch", [(self.__shard_for_id(row_id), (row_id, params)) for row_id, params in updates])
+
+    def delete_batch(self, item_ids: List[int]) -> List[dict]:
+        return self.__scatter("delete_batch", [(self.__shard_for_id(item_id), item_id) for item_id in item_ids])
+
+    def list(self) -> List[Dict]:
+        trades = [trade for worker in self.workers.values() for trade in worker.call("list")]
+        return sorted(trades, key=lambda trade: trade["id"])
+
+    def get_by_id(self, item_id):
+        worker = self.__worker_for_id(item_id)
+        return {} if worker is None else worker.call("get_by_id", item_id)
+
+    def __worker_for(self, symbol: str) -> ShardWorker:
+        return self.workers[self.ring.shard_for(symbol)]
+
+    def __worker_for_id(self, item_id) -> Optional[ShardWorker]:
+        shard = self.__shard_for_id(item_id)
+        return None if shard is None else self.workers[shard]
+
+    def __shard_for_id(self, item_id) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute("SELECT symbol FROM trades WHERE id=? UNION ALL SELECT symbol FROM trades_history WHERE id=? LIMIT 1", (item_id, item_id)).fetchone()
+        return None if row is None else self.ring.shard_for(row[0])
+
+    def __scatter(self, method: str, items: List[Tuple[Optional[int], object]]) -> List[dict]:
+        # Items whose trade no shard knows about come back empty, like a single call for an unknown ID
+        results: List[dict] = [{} for _ in items]
+        by_shard: Dict[int, List[int]] = {}
+        for position, (shard, _) in enumerate(items):
+            if shard is not None:
+                by_shard.setdefault(shard, []).append(position)
+        for shard, positions in by_shard.items():
+            rows = self.workers[shard].call(method, [items[position][1] for position in positions])
+            for position, row in zip(positions, rows):
+                results[position] = row
+        return results
@@ -0,0 +1,54 @@
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Dict, Iterator, Optional
+
+import metrics
+
+
+class StartupTimer:
+    """
+    Times each phase of boot and logs it by name, so a slow database, cache or exchange connection stands out.
+
+    Phases that the API and the trigger books do not need are started with `background` and finish on their
+    own threads, so nothing waits for the slowest of them.
+    """
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.durations: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.__record(name, perf_counter() - start)
+
+    def background(self, name: str, target: Callable[[], object], then: Optional[Callable[[], object]] = None) -> threading.Thread:
+        """Runs `target` as a timed phase on its own thread, followed by `then`, e.g. a refresh loop, on the same thread."""
+        def run():
+            try:
+                with self.phase(name):
+                    target()
+            except Exception:
+                logging.exception("Exception occurred in startup phase %s: ", name)
+            if then is not None:
+                then()
+        worker = threading.Thread(target=run, name="startup-%s" % name)
+        worker.start()
+        return worker
+
+    def report(self, milestone: str):
+        with self.lock:
+            durations = ", ".join("%s %.3fs" % (name, duration) for name, duration in self.durations.items())
+        logging.info("Startup reached %s after %.3fs. Phases finished so far: %s", milestone, perf_counter() - self.started, durations)
+
+    def __record(self, name: str, duration: float):
+        with self.lock:
+            self.durations[name] = duration
+        metrics.STARTUP_PHASE_SECONDS.set(name, duration)
+        logging.info("Startup phase %s finished in %.3fs, %.3fs after boot", name, duration, perf_counter() - self.started)
@@ -2,93 +2,158 @@ import logging
 import os
 import random
 import string
-from time import sleep
+from time import perf_counter, sleep
+from typing import Dict, List, Tuple
 
-from pybit import usdt_perpetual
 from pybit.exceptions import FailedRequestError, InvalidRequestError
 
+import metrics
+from account_state import ACCOUNT_STATE_RECONCILE_INTERVAL, AccountState, Conditional
+from exchange_client import ExchangeClient
+from instruments import InstrumentCache
 from models import TradesDao
+from order_executor import OrderExecutor
+from order_routing import OrderRouter
 from price_cache import PriceCache
+from trigger_engine import TriggerEngine, normalize_side
 
 BYBIT_EXCHANGE_URL = os.environ.get('BYBIT_EXCHANGE_URL', "https://api-testnet.bybit.com")
 BYBIT_API_KEY = os.getenv("BYBIT_API_KEY")
 BYBIT_API_SECRET = os.getenv("BYBIT_API_SECRET")
+# Seconds between full reconciliation sweeps of the trigger books. Set to 0 to rely on ticks alone
+STRATEGY_RECONCILE_INTERVAL = int(os.environ.get('STRATEGY_RECONCILE_INTERVAL', 30))
 
 class Strategy:
 
-    def __init__(self, trades_dao: TradesDao, price_cache: PriceCache):
+    def __init__(self, trades_dao: TradesDao, price_cache: PriceCache, exchange_client=None):
         self.trades_dao = trades_dao
         self.price_cache = price_cache
-        self.exchange_client = usdt_perpetual.HTTP(endpoint=BYBIT_EXCHANGE_URL, api_key=BYBIT_API_KEY, api_secret=BYBIT_API_SECRET)
+        # Anything with the pybit HTTP order and position methods, e.g. the simulated exchange used by replay.py
+        if exchange_client is None:
+            # Imported here so callers that bring their own client never load pybit's client modules
+            from pybit import usdt_perpetual
+            exchange_client = usdt_perpetual.HTTP(endpoint=BYBIT_EXCHANGE_URL, api_key=BYBIT_API_KEY, api_secret=BYBIT_API_SECRET)
+        self.exchange_client = ExchangeClient(exchange_client)
+        self.order_executor = OrderExecutor()
+        self.account_state = AccountState()
+        self.instruments = InstrumentCache(self.exchange_client)
+        self.order_router = OrderRouter()
+        # Orders sent to ByBit but not yet acknowledged, by order_link_id. Kept in runtime snapshots so an order
+        # that was in flight during a crash is still treated as open after the restart
+        self.pending_orders: Dict[str, Conditional] = {}
+        self.trigger_engine = TriggerEngine(self.__on_trigger)
+        TradesDao.add_listener(self.trigger_engine.sync)
+        self.trigger_engine.load(self.trades_dao.list_items())
 
-    def start_strategy(self):
+    def start_reconciliation(self):
+        # Fallback for missed ticks or DAO writes: rebuild the trigger books and re-evaluate against cached prices
+        while STRATEGY_RECONCILE_INTERVAL > 0:
+            sleep(STRATEGY_RECONCILE_INTERVAL)
+            self.trigger_engine.load(self.trades_dao.list_items())
+            self.trigger_engine.sweep(self.price_cache.read_prices(self.trigger_engine.symbols()))
+
+    def start_account_reconciliation(self):
+        # Seeds the account state mirror, then keeps it honest against the exchange in case a private stream message is missed
         while True:
-            for open_conditional in self.trades_dao.list_items():
-                is_conditional_already_open = bool(open_conditional["is_conditional_open"])
-                is_position_already_open = bool(open_conditional["is_position_open"])
-                if is_conditional_already_open or is_position_already_open:
-                    continue
-                symbol = str(open_conditional["symbol"])
-                price = self.price_cache.read_price(symbol)
-                if price is None:
-                    continue
-                current_price = float(price)
-                target_price = float(open_conditional["open_conditional_price"])
-                side = str(open_conditional["side"]).lower().capitalize()
-                condition_met = False
-                if side == "Buy":
-                    if current_price < target_price:
-                        condition_met = True
-                else:
-                    if current_price > target_price:
-                        condition_met = True
-                if condition_met:
-                    # In case websockets fail for whatever reason, we should double check we don't already have the position or conditional in place
-                    qty = float(open_conditional["quantity"])
-                    conditional_price = float(open_conditional["trigger_price"])
-                    is_valid_to_enter = self.__is_valid_entry(symbol, side, qty, conditional_price)
-                    if is_valid_to_enter:
-                        self.__place_order(symbol, side, qty, conditional_price, open_conditional)
-            sleep(5)
+            symbols = set(str(trade["symbol"]) for trade in self.trades_dao.list_items())
+            self.account_state.reconcile(self.exchange_client, symbols)
+            sleep(ACCOUNT_STATE_RECONCILE_INTERVAL)
+
+    def __on_trigger(self, open_conditional: dict):
+        # Called on the websocket thread, so only hand the trade to the executor. It is skipped if an earlier trigger is still being placed
+        triggered_at = perf_counter()
+        symbol = str(open_conditional["symbol"]).upper()
+        trade_id = open_conditional["id"]
+        self.order_executor.submit(symbol, trade_id, lambda: self.__enter_trade(open_conditional, triggered_at), lambda rejected: self.__rearm(trade_id, rejected))
+
+    def __rearm(self, trade_id: int, rejected: bool):
+        # A fired trade is out of its book. When the exchange refused every order it goes back in to fire on a later tick,
+        # instead of waiting for reconciliation. Read back from the DAO, since stream updates may have changed it meanwhile.
+        # Trades whose entry check failed or whose orders could not be built stay out until reconciliation or a DAO change
+        if rejected:
+            self.trigger_engine.sync(self.trades_dao.get_by_id(trade_id))
 
-    def __place_order(self, symbol: str, side: str, qty: float, conditional_price: float, open_conditional: dict):
+    def __enter_trade(self, open_conditional: dict, triggered_at: float) -> bool:
+        """Returns whether orders were sent and the exchange rejected all of them."""
+        symbol = str(open_conditional["symbol"])
+        side = normalize_side(open_conditional["side"])
+        # (trigger price, quantity) of each conditional order. A ladder trade enters all of its levels together
+        levels = [(float(price), float(qty)) for price, qty in open_conditional.get("levels") or [(open_conditional["trigger_price"], open_conditional["quantity"])]]
+        # In case websockets fail for whatever reason, we should double check we don't already have the position or conditional in place
+        start = perf_counter()
+        is_valid_to_enter = self.__is_valid_entry(symbol, side, levels)
+        metrics.VALID_ENTRY_SECONDS.observe(perf_counter() - start)
+        return is_valid_to_enter and self.__place_orders(symbol, side, levels, open_conditional, triggered_at)
+
+    def __place_orders(self, symbol: str, side: str, levels: List[Tuple[float, float]], open_conditional: dict, triggered_at: float) -> bool:
+        """Returns whether the orders were sent and the exchange rejected all of them."""
+        orders = []
+        rejected = False
         try:
             sl = float(open_conditional["sl_price"])
             tp = float(open_conditional["tp_price"])
-            rand = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(8))
-            order_id = "conditional_" + str(open_conditional["id"]) + "_" + rand
-            logging.info("Condition met to open conditional trade on %s. Conditional price: %s. SL price: %s. TP price: %s. Order ID: %s", symbol, conditional_price, sl, tp, order_id)
-            base_price_delta = conditional_price * 0.01
-            if side == "Buy": # stop_px > market price & base_price
-                base_price = conditional_price - base_price_delta
-            else:  # stop_px < market price & base_price
-                base_price = conditional_price + base_price_delta
-            base_price = conditional_price - base_price_delta if side == "Buy" else conditional_price + base_price_delta
-            precision = len(str(float(conditional_price)).split(".")[1])
-            base_price = round(base_price, precision)
-            self.exchange_client.place_conditional_order(symbol=symbol, side=side, order_type="Market", qty=qty, base_price=base_price, stop_px=conditional_price, time_in_force="GoodTillCancel", reduce_only=False, close_on_trigger=False, stop_loss=sl, take_profit=tp, trigger_by="LastPrice", order_link_id=order_id)
-            logging.info("--------------- NEW CONDITIONAL ORDER OPENED ---------------")
-            logging.info("Symbol: %s, Side: %s, Quantity: %s, Base Price: %s, Trigger Price: %s, SL Price: %s, TP Price: %s, Order ID: %s", symbol, side, qty, base_price, conditional_price, sl, tp, order_id)
-        except (FailedRequestError, InvalidRequestError):
-            logging.exception("Error occurred placing order with ByBit: ")
+            instrument = self.instruments.get(symbol)
+            for conditional_price, qty in levels:
+                rand = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(8))
+                order_id = "conditional_" + str(open_conditional["id"]) + "_" + rand
+                # Registered before the order is sent, since its stream updates can arrive before the REST response
+                self.order_router.register(order_id, open_conditional["id"])
+                logging.info("Condition met to open conditional trade on %s. Conditional price: %s. SL price: %s. TP price: %s. Order ID: %s", symbol, conditional_price, sl, tp, order_id)
+                base_price_delta = conditional_price * 0.01
+                # Buy: stop_px > market price & base_price. Sell: stop_px < market price & base_price
+                base_price = conditional_price - base_price_delta if side == "Buy" else conditional_price + base_price_delta
+                if instrument is not None:
+                    base_price = instrument.round_price(base_price)
+                else:
+                    # No rules cached for the symbol, so guess the precision from the trigger price
+                    base_price = round(base_price, len(str(float(conditional_price)).split(".")[1]))
+                self.pending_orders[order_id] = (symbol.upper(), side, qty, conditional_price)
+                orders.append(dict(symbol=symbol, side=side, order_type="Market", qty=qty, base_price=base_price, stop_px=conditional_price, time_in_force="GoodTillCancel", reduce_only=False, close_on_trigger=False, stop_loss=sl, take_profit=tp, trigger_by="LastPrice", order_link_id=order_id))
+            start = perf_counter()
+            results = self.exchange_client.place_conditional_orders(orders)
+            placed_at = perf_counter()
+            metrics.PLACE_ORDER_SECONDS.observe(placed_at - start)
+            rejected = all(isinstance(result, Exception) for result in results)
+            if not rejected:
+                # Only accepted orders count, so failed placements do not skew the latency
+                metrics.TRIGGER_TO_ORDER_SECONDS.observe(placed_at - triggered_at)
+            for order, result in zip(orders, results):
+                if isinstance(result, (FailedRequestError, InvalidRequestError)):
+                    metrics.REST_ERRORS.inc("place_conditional_order")
+                    logging.error("Error occurred placing order with ByBit: ", exc_info=result)
+                elif isinstance(result, Exception):
+                    logging.error("Unknown exception occurred placing order: ", exc_info=result)
+                else:
+                    self.account_state.add_conditional(order["order_link_id"], symbol, side, order["qty"], order["stop_px"])
+                    logging.info("--------------- NEW CONDITIONAL ORDER OPENED ---------------")
+                    logging.info("Symbol: %s, Side: %s, Quantity: %s, Base Price: %s, Trigger Price: %s, SL Price: %s, TP Price: %s, Order ID: %s", symbol, side, order["qty"], order["base_price"], order["stop_px"], sl, tp, order["order_link_id"])
         except Exception:
             logging.exception("Unknown exception occurred constructing order: ")
+        finally:
+            for order in orders:
+                self.pending_orders.pop(order["order_link_id"], None)
+        return rejected
 
-    def __is_valid_entry(self, symbol: str, side: str, qty: float, conditional_price: float):
+    def __is_valid_entry(self, symbol: str, side: str, levels: List[Tuple[float, float]]):
+        if self.account_state.is_fresh():
+            return not any(self.account_state.has_conditional(symbol, side, qty, conditional_price) for conditional_price, qty in levels) \
+                and not self.account_state.has_position(symbol, side)
+        logging.info("Account state mirror is stale. Checking for existing conditional/position orders on ByBit for %s", symbol)
         is_conditional_exists = False
         is_position_exists = False
         try:
-            # Ensure there's not already a conditional with same symbol, side, quantity and trigger price
+            # Ensure there's not already a conditional with same symbol, side, quantity and trigger price as any level
             conditional_orders = self.exchange_client.query_conditional_order(symbol=symbol)
             if conditional_orders is not None:
                 result = conditional_orders["result"]
-                is_conditional_exists = len([x for x in result if side == str(x["side"]) and qty == float(x["qty"]) and float(x["trigger_price"]) == conditional_price]) > 0
+                is_conditional_exists = len([x for x in result if side == str(x["side"]) and (float(x["trigger_price"]), float(x["qty"])) in levels]) > 0
             # Ensure there's not already a position with same symbol and side
             open_positions = self.exchange_client.my_position(symbol=symbol)
             if open_positions is not None:
                 result = open_positions["result"]
                 is_position_exists = len([x for x in result if side == str(x["side"]) and float(x["size"]) > 0]) > 0
         except (FailedRequestError, InvalidRequestError):
+            metrics.REST_ERRORS.inc("valid_entry_check")
             logging.exception("Error occurred querying existing conditional/position orders on ByBit. Will not place new conditional order: ")
             return False
         except Exception:
@@ -0,0 +1,255 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Imported by the first TriggerEngine rather than at module load, so processes without trigger books never pay for it
+numpy = None
+
+BUY = "Buy"
+SELL = "Sell"
+
+
+def load_numpy() -> bool:
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            return False
+        numpy = module
+    return True
+
+
+class TriggerBook:
+    """Armed trades for one symbol and side, kept sorted by open_conditional_price."""
+
+    def __init__(self):
+        self.keys: List[Tuple[float, int]] = []
+        self.trades: Dict[int, dict] = {}
+
+    def add(self, price: float, trade: dict):
+        trade_id = trade["id"]
+        insort(self.keys, (price, trade_id))
+        self.trades[trade_id] = trade
+
+    def remove(self, price: float, trade_id: int):
+        index = bisect_left(self.keys, (price, trade_id))
+        if index < len(self.keys) and self.keys[index] == (price, trade_id):
+            del self.keys[index]
+        self.trades.pop(trade_id, None)
+
+    def pop_above(self, price: float) -> List[dict]:
+        # Buy entries trigger once price trades below open_conditional_price
+        index = bisect_right(self.keys, (price, float("inf")))
+        return self.__pop(index, len(self.keys))
+
+    def pop_below(self, price: float) -> List[dict]:
+        # Sell entries trigger once price trades above open_conditional_price
+        index = bisect_left(self.keys, (price, float("-inf")))
+        return self.__pop(0, index)
+
+    def __pop(self, start: int, end: int) -> List[dict]:
+        if start >= end:
+            return []
+        fired = [self.trades.pop(trade_id) for _, trade_id in self.keys[start:end]]
+        del self.keys[start:end]
+        return fired
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class TriggerColumns:
+    """
+    Armed trades as parallel NumPy arrays of trade ID, open_conditional_price, side sign and symbol index, so a
+    sweep over every symbol is a few vectorized comparisons instead of a loop over books.
+
+    Rows are written in place as trades are armed and disarmed. Freed rows are reused and the arrays double
+    when they run out of room.
+    """
+
+    def __init__(self):
+        self.rows: Dict[int, int] = {}
+        self.free: List[int] = []
+        self.symbols: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.size = 0
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.prices = numpy.zeros(0, dtype=numpy.float64)
+        self.signs = numpy.zeros(0, dtype=numpy.int8)
+        self.symbol_index = numpy.zeros(0, dtype=numpy.int32)
+        self.armed = numpy.zeros(0, dtype=bool)
+
+    def load(self, entries: List[Tuple[int, str, str, float]]):
+        """Replaces every row with (trade ID, symbol, side, open_conditional_price) entries."""
+        self.symbols = {}
+        self.names = []
+        self.rows = {trade_id: row for row, (trade_id, _, _, _) in enumerate(entries)}
+        self.free = []
+        self.size = len(entries)
+        self.ids = numpy.array([entry[0] for entry in entries], dtype=numpy.int64)
+        self.prices = numpy.array([entry[3] for entry in entries], dtype=numpy.float64)
+        self.signs = numpy.array([1 if entry[2] == BUY else -1 for entry in entries], dtype=numpy.int8)
+        self.symbol_index = numpy.array([self.__symbol(entry[1]) for entry in entries], dtype=numpy.int32)
+        self.armed = numpy.ones(len(entries), dtype=bool)
+
+    def arm(self, trade_id: int, symbol: str, side: str, price: float):
+        row = self.__row(trade_id)
+        if row is None:
+            row = self.free.pop() if len(self.free) > 0 else self.__append()
+            self.rows[trade_id] = row
+        self.ids[row] = trade_id
+        self.prices[row] = price
+        self.signs[row] = 1 if side == BUY else -1
+        self.symbol_index[row] = self.__symbol(symbol)
+        self.armed[row] = True
+
+    def disarm(self, trade_id: int):
+        row = self.__row(trade_id)
+        if row is not None:
+            self.armed[row] = False
+            self.free.append(row)
+
+    def take_crossed(self, prices: Dict[str, Optional[float]]) -> List[str]:
+        """
+        Disarms every trade whose open_conditional_price its symbol's price has crossed, and returns those symbols.
+        The rows are freed in bulk, so firing thousands of trades costs no per-trade bookkeeping here.
+        """
+        vector = numpy.full(len(self.symbols), numpy.nan)
+        for symbol, price in prices.items():
+            index = self.symbols.get(symbol)
+            if index is not None and price is not None:
+                vector[index] = price
+        size = self.size
+        current = vector[self.symbol_index[:size]]
+        # Same strict comparisons as the books: Buys fire below the open price and Sells above it. NaN never fires
+        fired = numpy.flatnonzero(self.armed[:size] & (self.signs[:size] * (self.prices[:size] - current) > 0))
+        self.armed[fired] = False
+        self.free.extend(fired.tolist())
+        return [self.names[index] for index in numpy.unique(self.symbol_index[fired]).tolist()]
+
+    def __row(self, trade_id: int) -> Optional[int]:
+        # Entries for fired trades are left behind by take_crossed, so a row only counts while it still holds the trade
+        row = self.rows.get(trade_id)
+        return row if row is not None and self.armed[row] and self.ids[row] == trade_id else None
+
+    def __symbol(self, symbol: str) -> int:
+        index = self.symbols.get(symbol)
+        if index is None:
+            index = self.symbols[symbol] = len(self.names)
+            self.names.append(symbol)
+        return index
+
+    def __append(self) -> int:
+        if self.size == len(self.ids):
+            grow = max(64, len(self.ids))
+            self.ids = numpy.concatenate([self.ids, numpy.zeros(grow, dtype=numpy.int64)])
+            self.prices = numpy.concatenate([self.prices, numpy.zeros(grow, dtype=numpy.float64)])
+            self.signs = numpy.concatenate([self.signs, numpy.zeros(grow, dtype=numpy.int8)])
+            self.symbol_index = numpy.concatenate([self.symbol_index, numpy.zeros(grow, dtype=numpy.int32)])
+            self.armed = numpy.concatenate([self.armed, numpy.zeros(grow, dtype=bool)])
+        self.size += 1
+        return self.size - 1
+
+
+class TriggerEngine:
+    """
+    Evaluates entry conditions on every price tick.
+
+    Armed trades (active, with no conditional or position open) are held in per-symbol Buy and Sell books.
+    Each tick bisects both books and hands only the crossed trades to `on_trigger`. Fired trades leave the book
+    and are re-armed by the next DAO write or reconciliation that reports them as eligible again.
+    """
+
+    def __init__(self, on_trigger: Callable[[dict], None]):
+        self.on_trigger = on_trigger
+        self.books: Dict[str, Dict[str, TriggerBook]] = {}
+        self.armed: Dict[int, Tuple[str, str, float]] = {}
+        # Only kept when NumPy is installed. Without it, sweeps bisect each symbol's books instead
+        self.columns: Optional[TriggerColumns] = TriggerColumns() if load_numpy() else None
+        self.lock = threading.Lock()
+
+    def on_price(self, symbol: str, price: float):
+        with self.lock:
+            fired = self.__pop_crossed(symbol.upper(), price)
+        for trade in fired:
+            self.on_trigger(trade)
+
+    def sweep(self, prices: Dict[str, Optional[float]]):
+        """Evaluates every symbol against its latest price at once, e.g. in the reconciliation sweep."""
+        if self.columns is None:
+            for symbol, price in prices.items():
+                if price is not None:
+                    self.on_price(symbol, float(price))
+            return
+        with self.lock:
+            # The crossed trades of a book are one contiguous slice, so each crossed symbol is popped like a tick.
+            # Their rows are already disarmed by take_crossed
+            fired = [trade for symbol in self.columns.take_crossed(prices) for trade in self.__pop_crossed(symbol, float(prices[symbol]), False)]
+        for trade in fired:
+            self.on_trigger(trade)
+
+    def sync(self, trade: dict):
+        """Re-files a single trade after it has been written through the DAO."""
+        trade_id = trade.get("id")
+        if trade_id is None:
+            return
+        with self.lock:
+            self.__disarm(trade_id)
+            if self.__is_armed(trade):
+                self.__arm(trade)
+
+    def load(self, trades: List[dict]):
+        """Rebuilds every book from a full list of active trades."""
+        with self.lock:
+            self.books = {}
+            self.armed = {}
+            for trade in trades:
+                if self.__is_armed(trade):
+                    self.__arm(trade, False)
+            if self.columns is not None:
+                self.columns.load([(trade_id, symbol, side, price) for trade_id, (symbol, side, price) in self.armed.items()])
+
+    def symbols(self) -> List[str]:
+        with self.lock:
+            return [symbol for symbol, sides in self.books.items() if len(sides[BUY]) > 0 or len(sides[SELL]) > 0]
+
+    def __pop_crossed(self, symbol: str, price: float, update_columns: bool = True) -> List[dict]:
+        sides = self.books.get(symbol)
+        if sides is None:
+            return []
+        fired = sides[BUY].pop_above(price) + sides[SELL].pop_below(price)
+        for trade in fired:
+            self.armed.pop(trade["id"], None)
+            if update_columns and self.columns is not None:
+                self.columns.disarm(trade["id"])
+        return fired
+
+    def __arm(self, trade: dict, update_columns: bool = True):
+        symbol = str(trade["symbol"]).upper()
+        side = normalize_side(trade["side"])
+        price = float(trade["open_conditional_price"])
+        sides = self.books.setdefault(symbol, {BUY: TriggerBook(), SELL: TriggerBook()})
+        sides[side].add(price, trade)
+        self.armed[trade["id"]] = (symbol, side, price)
+        if update_columns and self.columns is not None:
+            self.columns.arm(trade["id"], symbol, side, price)
+
+    def __disarm(self, trade_id: int):
+        location: Optional[Tuple[str, str, float]] = self.armed.pop(trade_id, None)
+        if location is None:
+            return
+        symbol, side, price = location
+        self.books[symbol][side].remove(price, trade_id)
+        if self.columns is not None:
+            self.columns.disarm(trade_id)
+
+    @staticmethod
+    def __is_armed(trade: dict) -> bool:
+        return bool(trade.get("is_active", True)) \
+            and not bool(trade.get("is_conditional_open")) \
+            and not bool(trade.get("is_position_open"))
+
+
+def normalize_side(side: str) -> str:
+    return BUY if str(side).lower() == "buy" else SELL
@@ -1,142 +1,385 @@
+import json
 import logging
 import os
-from typing import Dict, List
-
-from pybit import usdt_perpetual
+import queue
+import threading
+from time import perf_counter, sleep, time
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
+import metrics
+from account_state import AccountState
+from log_pipeline import log_payload
 from models import TradesDao
+from order_routing import OrderRouter
 from price_cache import PriceCache
+from trigger_engine import TriggerEngine
 
-BYBIT_TESTNET_EXCHANGE = bool(os.getenv("BYBIT_TESTNET_EXCHANGE").lower() in ('true'))
+BYBIT_TESTNET_EXCHANGE = bool(os.getenv("BYBIT_TESTNET_EXCHANGE", "True").lower() in ('true',))
 BYBIT_API_KEY = os.getenv("BYBIT_API_KEY")
 BYBIT_API_SECRET = os.getenv("BYBIT_API_SECRET")
 BYBIT_EXCHANGE_DOMAIN = "bybit"
 # Retries set to 0 gives infinite retries
 RETRIES=0
+# Private stream messages that may wait to be handled. Further messages are dropped and entry checks fall back to REST
+WEBSOCKET_PRIVATE_QUEUE_SIZE = int(os.environ.get('WEBSOCKET_PRIVATE_QUEUE_SIZE', 10000))
+# Seconds between checks of the private socket. While it is down, or after it reconnects, entry checks fall back to REST
+PRIVATE_STREAM_CHECK_INTERVAL = float(os.environ.get('PRIVATE_STREAM_CHECK_INTERVAL', 1))
+
+# Seconds to wait after a trade change so subscriptions for several new symbols go out as one websocket op
+SUBSCRIPTION_BATCH_WINDOW = float(os.environ.get('SUBSCRIPTION_BATCH_WINDOW', 0.1))
+INSTRUMENT_INFO_TOPIC = "instrument_info.100ms.{}"
+# Order statuses that mean some or all of an order has executed
+FILLED_STATUSES = {"Filled", "PartiallyFilled"}
+
+
+class SubscriptionManager:
+    """
+    Reference counts active trades per symbol and keeps the price subscriptions in step.
+
+    It listens to TradesDao writes, so a new symbol is subscribed as soon as its first trade is created and
+    dropped once its last trade is deactivated. Changes are collected for SUBSCRIPTION_BATCH_WINDOW and applied
+    in a single subscribe and a single unsubscribe.
+    """
+
+    def __init__(self, subscribe: Callable[[List[str]], None], unsubscribe: Callable[[List[str]], None]):
+        self.subscribe = subscribe
+        self.unsubscribe = unsubscribe
+        self.refs: Dict[str, int] = {}
+        self.trade_symbols: Dict[int, str] = {}
+        # Symbols whose ticks are handled. Read on the pybit thread for every tick, so it is only ever replaced
+        self.wanted: frozenset = frozenset()
+        self.subscribed: Set[str] = set()
+        self.pending: Set[str] = set()
+        self.changed = threading.Condition()
+
+    def load(self, trades: List[dict]):
+        for trade in trades:
+            self.sync(trade)
+        self.flush()
+
+    def sync(self, trade: dict):
+        """TradesDao listener. Counts the trade while it is active, for the symbol it was created with."""
+        trade_id = trade.get("id")
+        if trade_id is None:
+            return
+        with self.changed:
+            symbol = self.trade_symbols.get(trade_id)
+            is_active = bool(trade.get("is_active", True))
+            if is_active and symbol is None and trade.get("symbol") is not None:
+                symbol = str(trade["symbol"]).upper()
+                self.trade_symbols[trade_id] = symbol
+                self.refs[symbol] = self.refs.get(symbol, 0) + 1
+            elif not is_active and symbol is not None:
+                del self.trade_symbols[trade_id]
+                self.refs[symbol] -= 1
+                if self.refs[symbol] == 0:
+                    del self.refs[symbol]
+            else:
+                return
+            self.pending.add(symbol)
+            self.changed.notify()
+
+    def start(self):
+        while True:
+            with self.changed:
+                while len(self.pending) == 0:
+                    self.changed.wait()
+            sleep(SUBSCRIPTION_BATCH_WINDOW)
+            self.flush()
+
+    def flush(self):
+        with self.changed:
+            added = sorted(symbol for symbol in self.pending if symbol in self.refs and symbol not in self.subscribed)
+            dropped = sorted(symbol for symbol in self.pending if symbol not in self.refs and symbol in self.subscribed)
+            self.pending.clear()
+            self.subscribed.difference_update(dropped)
+            self.subscribed.update(added)
+            self.wanted = frozenset(self.subscribed)
+        if len(dropped) > 0:
+            logging.info("No active trades left. Unsubscribing from price stream for %s", dropped)
+            try:
+                self.unsubscribe(dropped)
+            except Exception:
+                logging.exception("Exception occurred unsubscribing from %s. Their ticks will be ignored: ", dropped)
+        if len(added) > 0:
+            logging.info("Subscribing to price stream for %s", added)
+            try:
+                self.subscribe(added)
+            except Exception:
+                logging.exception("Exception occurred subscribing to %s: ", added)
+                with self.changed:
+                    # Retried on the next change or flush
+                    self.subscribed.difference_update(added)
+                    self.pending.update(added)
+
 
 class WebsocketStreams:
+    """
+    Subscribes to the Bybit streams and keeps the pybit callbacks down to a dict write or a queue put.
+
+    Only the latest tick per symbol is kept until the price worker gets to it, so a slow sweep drops stale prices
+    instead of building a backlog. Private stream messages are handled strictly in arrival order on their own
+    worker, so DAO writes and logging never stall the socket reader. Each private message is routed by
+    order_link_id and applied as a single DAO batch.
+    """
 
-    def __init__(self, price_cache: PriceCache, trades_dao: TradesDao):
+    def __init__(self, price_cache: PriceCache, trades_dao: TradesDao, trigger_engine: Optional[TriggerEngine] = None, account_state: Optional[AccountState] = None, websocket=None, order_router: Optional[OrderRouter] = None):
         self.price_cache = price_cache
         self.trades_dao = trades_dao
-        self.active_symbols = set()
+        self.trigger_engine = trigger_engine
+        self.account_state = account_state
+        # Shared with Strategy, which registers the order_link_id of every order it sends
+        self.order_router = order_router if order_router is not None else OrderRouter()
         self.prices = {}
-        self.websocket = usdt_perpetual.WebSocket(test=BYBIT_TESTNET_EXCHANGE, api_key=BYBIT_API_KEY, api_secret=BYBIT_API_SECRET, domain=BYBIT_EXCHANGE_DOMAIN, retries=RETRIES)
-    
-    def subscribe_to_price_stream(self, symbols: List[str]):
-        for symbol in symbols:
-            logging.info("Subscribing %s to price stream", symbol)
-            self.active_symbols.add(symbol)
-            self.subscribe(symbol=symbol)
-        return self.active_symbols
+        # Anything with the pybit WebSocket stream methods, e.g. the replay feed in replay.py
+        if websocket is None:
+            from pybit import usdt_perpetual
+            websocket = usdt_perpetual.WebSocket(test=BYBIT_TESTNET_EXCHANGE, api_key=BYBIT_API_KEY, api_secret=BYBIT_API_SECRET, domain=BYBIT_EXCHANGE_DOMAIN, retries=RETRIES)
+        self.websocket = websocket
+        self.latest_ticks: Dict[str, dict] = {}
+        self.ticks_in_progress = 0
+        self.tick_ready = threading.Condition()
+        self.private_events: "queue.Queue[Tuple[Callable[[dict], None], dict]]" = queue.Queue(maxsize=WEBSOCKET_PRIVATE_QUEUE_SIZE)
+        metrics.PENDING_TICKS.set_function(lambda: len(self.latest_ticks))
+        metrics.PRIVATE_BACKLOG.set_function(self.private_events.qsize)
+        threading.Thread(target=self.__process_ticks, name="ticks", daemon=True).start()
+        threading.Thread(target=self.__process_private_events, name="private-events", daemon=True).start()
+        self.subscriptions = SubscriptionManager(self.__subscribe, self.__unsubscribe)
+        TradesDao.add_listener(self.subscriptions.sync)
+
+    def start_price_listener(self):
+        # Opens the public socket with one subscribe op for the symbols of active trades, then follows trade changes
+        self.subscriptions.load(self.trades_dao.list_items())
+        threading.Thread(target=self.subscriptions.start, name="subscriptions", daemon=True).start()
     
-    def subscribe(self, symbol):
-        self.websocket.instrument_info_stream(self.__handle_instrument_info, symbol)
+    def __subscribe(self, symbols: List[str]):
+        # pybit sends every symbol in the list as one subscribe op
+        self.websocket.instrument_info_stream(self.__on_instrument_info, symbols)
+
+    def __unsubscribe(self, symbols: List[str]):
+        # pybit 2.4 has no unsubscribe call, so the op is sent on its public socket when it has one open.
+        # pybit may still resubscribe these after a reconnect, which is harmless because unwanted ticks are ignored
+        public_socket = getattr(getattr(self.websocket, "ws_public", None), "ws", None)
+        if public_socket is not None:
+            public_socket.send(json.dumps({"op": "unsubscribe", "args": [INSTRUMENT_INFO_TOPIC.format(symbol) for symbol in symbols]}))
 
     def start_position_listener(self):
-        self.websocket.position_stream(self.__handle_position_update)
-        self.websocket.stop_order_stream(self.__handle_stop_order_update)
-        self.websocket.order_stream(self.__handle_order_update)
+        self.websocket.position_stream(lambda message: self.__on_private_event("position", self.__handle_position_update, message))
+        self.websocket.stop_order_stream(lambda message: self.__on_private_event("stop_order", self.__handle_stop_order_update, message))
+        self.websocket.order_stream(lambda message: self.__on_private_event("order", self.__handle_order_update, message))
+        if self.account_state is not None:
+            threading.Thread(target=self.__watch_private_socket, name="private-watchdog", daemon=True).start()
+
+    def is_idle(self) -> bool:
+        with self.tick_ready:
+            ticks_idle = len(self.latest_ticks) == 0 and self.ticks_in_progress == 0
+        return ticks_idle and self.private_events.unfinished_tasks == 0
+
+    def __on_instrument_info(self, message):
+        # Runs on the pybit thread. Overwrites any tick for the symbol that has not been handled yet
+        try:
+            symbol = message["data"]["symbol"]
+        except (KeyError, TypeError):
+            logging.warning("No symbol received in price update message: %s", message)
+            return
+        if symbol not in self.subscriptions.wanted:
+            return
+        metrics.TICKS.inc(symbol)
+        with self.tick_ready:
+            if symbol in self.latest_ticks:
+                metrics.TICKS_COALESCED.inc(symbol)
+            self.latest_ticks[symbol] = message
+            self.tick_ready.notify()
+
+    def __on_private_event(self, stream: str, handler: Callable[[dict], None], message):
+        # Runs on the pybit thread
+        try:
+            self.private_events.put_nowait((handler, message))
+        except queue.Full:
+            metrics.PRIVATE_EVENTS_DROPPED.inc(stream)
+            logging.error("Private event queue is full. Dropped %s message: %s", stream, message)
+            # Whatever the message said is now unknown, so entry checks go back to REST until the next snapshot
+            if self.account_state is not None:
+                self.account_state.mark_stale()
+
+    def __watch_private_socket(self):
+        # pybit reconnects on its own without telling its callers, and anything sent while the socket was down is lost.
+        # A new connection shows up as a new WebSocketApp. Replay feeds have no private socket to watch
+        connection = None
+        was_connected = True
+        while True:
+            sleep(PRIVATE_STREAM_CHECK_INTERVAL)
+            manager = getattr(self.websocket, "ws_private", None)
+            if manager is None:
+                continue
+            socket = getattr(manager, "ws", None)
+            is_connected = manager.is_connected()
+            reconnected = connection is not None and socket is not connection
+            if not is_connected or reconnected:
+                # Trusted again once the next REST snapshot succeeds with the socket up
+                self.account_state.mark_stale()
+                if is_connected or was_connected:
+                    logging.warning("Private websocket %s. Entry checks fall back to REST until the next account snapshot", "reconnected" if is_connected else "disconnected")
+            connection = socket
+            was_connected = is_connected
+
+    def __process_ticks(self):
+        while True:
+            with self.tick_ready:
+                while len(self.latest_ticks) == 0:
+                    self.tick_ready.wait()
+                ticks, self.latest_ticks = self.latest_ticks, {}
+                self.ticks_in_progress = len(ticks)
+            for message in ticks.values():
+                self.__handle_instrument_info(message)
+            with self.tick_ready:
+                self.ticks_in_progress = 0
+
+    def __process_private_events(self):
+        while True:
+            handler, message = self.private_events.get()
+            try:
+                handler(message)
+            finally:
+                self.private_events.task_done()
 
     def __handle_instrument_info(self, message):
+        start = perf_counter()
         try:
             symbol = message["data"]["symbol"]
             price = message["data"]["last_price"]
+            timestamp = message.get("timestamp_e6")
+            if timestamp is not None:
+                # How far behind the exchange we are handling ticks, i.e. how backed up the stream is
+                metrics.TICK_LAG_SECONDS.observe(max(0.0, time() - int(timestamp) / 1e6))
             self.prices[symbol] = price
-            self.price_cache.upsert_price(symbol, price)
+            self.price_cache.upsert_price(symbol, price, None if timestamp is None else int(timestamp) / 1e6)
+            if self.trigger_engine is not None:
+                evaluation_start = perf_counter()
+                self.trigger_engine.on_price(symbol, float(price))
+                metrics.TRIGGER_EVALUATION_SECONDS.observe(perf_counter() - evaluation_start)
         except Exception:
             logging.exception("Exception occurred handling price update: ")
+        metrics.TICK_HANDLER_SECONDS.observe(perf_counter() - start)
 
     def __handle_position_update(self, message):
-        logging.info("- POSITION UPDATE -")
-        logging.info(message)
+        metrics.WEBSOCKET_MESSAGES.inc("position")
+        log_payload("position", message)
         try:
             data: List[Dict] = message["data"]
             if data is None or len(data) == 0:
                 logging.warning("No data received in position update message: %s", message)
                 return
-            open_positions = [update for update in data if float(update["size"]) > 0]
-            closed_positions = [update for update in data if float(update["size"]) == 0]
-            # If there are no open positions, it indicates that the position is now closed and we should ensure the DB reflects this
-            for closed_position in closed_positions:
-                symbol = closed_position["symbol"]
-                side = closed_position["side"]
-                matching_trades = self.trades_dao.query_trades(symbol=symbol, side=side)
-                db_open_positions = [trade for trade in matching_trades if trade["is_position_open"]]
-                for open_position in db_open_positions:
-                    row_id = open_position["id"]
-                    self.trades_dao.update(row_id, params={"is_position_open": False})
-            
-            for open_position in open_positions:
-                # Ensure DB reflects that this position is open
-                symbol = open_position["symbol"]
-                side = open_position["side"]
-                qty = open_position["size"]
-                matched_trades = self.trades_dao.query_trades(symbol, side, qty)
-                for matched_trade in matched_trades:
-                    row_id = matched_trade["id"]
-                    self.trades_dao.update(row_id, params={"is_position_open": True})
+            if self.account_state is not None:
+                for update in data:
+                    self.account_state.on_position(update)
+            flags: Dict[int, bool] = {}
+            for position in data:
+                symbol = position["symbol"]
+                side = position["side"]
+                is_open = float(position["size"]) > 0
+                if is_open:
+                    # Trades whose entry orders filled into this position, otherwise any trade of the same size
+                    trade_ids = self.order_router.holders_of(symbol, side)
+                    if trade_ids is None:
+                        trade_ids = [trade["id"] for trade in self.trades_dao.query_trades(symbol, side, position["size"])]
+                else:
+                    # The position is closed, so none of the trades on this side hold it any more
+                    self.order_router.clear_holders(symbol, side)
+                    trade_ids = [trade["id"] for trade in self.trades_dao.query_trades(symbol=symbol, side=side)]
+                for trade_id in trade_ids:
+                    flags[trade_id] = is_open
+            # Position flags are only read back by the trigger books, so the batch is queued without waiting for the commit.
+            # Bybit repeats unchanged positions, and the writer skips trades whose flag is already set
+            self.trades_dao.set_position_open_async(flags)
         except Exception:
             logging.exception("Exception occurred handling position update: ")
         
     def __handle_stop_order_update(self, message):
-        logging.info("- STOP ORDER UPDATE -")
-        logging.info(message)
+        metrics.WEBSOCKET_MESSAGES.inc("stop_order")
+        log_payload("stop_order", message)
         try:
             data: List[Dict] = message["data"]
             if data is None or len(data) == 0:
                 logging.warning("No data received in stop order update message: %s", message)
                 return
+            updates: Dict[int, dict] = {}
             for update in data:
-                # Handle placement of conditional stop orders
-                order_id = str(update["order_link_id"])
-                is_conditional_order = '_' in order_id and order_id.split('_')[0] == "conditional"
-                if is_conditional_order:
-                    logging.info("Found conditional order update")
-                    # If the conditional order has an order status of untriggered, it indicates the conditional order is pending and we should update the DB accordingly
-                    row_id = order_id.split('_')[1]
-                    is_open = update["order_status"] == "Untriggered"
-                    self.trades_dao.update(row_id, params={"is_conditional_open": is_open})
-                    # If the user manually cancels the conditional order, then deactivate the trade from entering again
-                    is_cancelled = update["cancel_type"] == "CancelByUser" and update["order_status"] == "Deactivated"
-                    if is_cancelled:
-                        self.trades_dao.deactivate_trade(row_id)
+                if self.account_state is not None:
+                    self.account_state.on_stop_order(update)
+                # Only conditional orders placed by Strategy route to a trade, and only to one this process trades.
+                # In a shard worker the shared account also reports orders of trades owned by other shards
+                trade_id = self.order_router.trade_for_link(update["order_link_id"])
+                trade = {} if trade_id is None else self.trades_dao.get_by_id(trade_id)
+                if len(trade) == 0 or self.order_router.is_duplicate("stop_order", update.get("stop_order_id"), update["order_status"]):
+                    continue
+                logging.info("Found conditional order update")
+                # If the conditional order has an order status of untriggered, it indicates the conditional order is pending and we should update the DB accordingly.
+                # A ladder trade stays pending while any of its levels is untriggered
+                is_open = self.order_router.conditional_update(trade_id, update["order_link_id"], update["order_status"] == "Untriggered")
+                params = {"is_conditional_open": is_open}
+                # If the user manually cancels the conditional order, then deactivate the trade from entering again
+                if update["cancel_type"] == "CancelByUser" and update["order_status"] == "Deactivated":
+                    params["is_active"] = False
+                # Compared with any change already collected from this message, since it is applied after the loop
+                current = dict(trade, **updates.get(trade_id, {}))
+                if all(bool(current[key]) == value for key, value in params.items()):
+                    continue
+                updates.setdefault(trade_id, {}).update(params)
+            if len(updates) > 0:
+                self.trades_dao.update_batch(list(updates.items()))
         except Exception:
             logging.exception("Exception occurred handling stop order update: ")
 
     def __handle_order_update(self, message):
-        logging.info("- ORDER UPDATE -")
-        logging.info(message)
+        metrics.WEBSOCKET_MESSAGES.inc("order")
+        log_payload("order", message)
         try:
             data: List[Dict] = message["data"]
             if data is None or len(data) == 0:
                 logging.warning("No data received in order update message: %s", message)
                 return
+            stop_losses: Dict[int, int] = {}
+            closed: Set[int] = set()
             for update in data:
-                flipped_side = self.__flip_side(str(update["side"]))
+                order_status = update["order_status"]
+                if order_status not in FILLED_STATUSES or self.order_router.is_duplicate("order", update.get("order_id"), order_status):
+                    continue
                 symbol = update["symbol"]
+                side = str(update["side"])
                 create_type = update["create_type"]
-                order_status = update["order_status"]
-                order_id = update["order_link_id"]
-                matching_trades = [trade for trade in self.trades_dao.query_trades(symbol=symbol, side=flipped_side) if not trade["is_conditional_open"]]
+                order_link_id = update["order_link_id"]
+                trade_id = self.order_router.trade_for_link(order_link_id)
+                if trade_id is not None:
+                    # Our own entry order filled, so the trade now holds the position on its side. Fills of trades
+                    # this process does not trade, e.g. another shard's, are left to their owner
+                    if len(self.trades_dao.get_by_id(trade_id)) > 0:
+                        self.order_router.add_holder(symbol, side, trade_id)
+                    continue
+                flipped_side = self.__flip_side(side)
+                holders = self.order_router.holders_of(symbol, flipped_side)
+                if holders is None:
+                    holders = [trade["id"] for trade in self.trades_dao.query_trades(symbol=symbol, side=flipped_side) if not trade["is_conditional_open"]]
                 # If any part of the position is closed out by non-StopLoss type orders, then deactivate trade completely.
                 # By not deactivating for CreateByStopLoss orders here it will cause the conditional order to be re-entered automatically.
-                if "Filled" in order_status and "CreateByStopLoss" not in create_type and not order_id:
+                if "CreateByStopLoss" not in create_type and not order_link_id:
                     logging.info("Received update for FILLED order of type: %s. Will deactivate trade", create_type)
-                    for matching_trade in matching_trades:
-                        row_id = matching_trade["id"]
+                    for row_id in holders:
                         logging.info("Deactivating trade: %s", row_id)
-                        self.trades_dao.deactivate_trade(row_id)
+                        closed.add(row_id)
                 # If it's a StopLoss order, then increment the SL count in the DB
-                elif "Filled" in order_status:
+                else:
                     logging.info("Received update for FILLED order of type: %s", create_type)
-                    for matching_trade in matching_trades:
-                        row_id = matching_trade["id"]
+                    # A stop loss that fills in parts is still one stop loss, so it is counted once per order
+                    if self.order_router.is_duplicate("stop_loss", update.get("order_id")):
+                        continue
+                    for row_id in holders:
                         logging.info("Incrementing SL counter for trade ID: %s", row_id)
-                        updated_row = self.trades_dao.increment_sl_counter(row_id)
-                        if int(updated_row["sl_counter"]) >= int(updated_row["max_sl_count"]):
-                            logging.info("Max StopLoss count has been reached. Deactivating trade: %s", row_id)
-                            self.trades_dao.deactivate_trade(row_id)
+                        stop_losses[row_id] = stop_losses.get(row_id, 0) + 1
+            # Trades reaching max_sl_count are deactivated in the same transaction as the increment
+            for updated_row in self.trades_dao.apply_order_fills(stop_losses, sorted(closed)):
+                if updated_row.get("id") in stop_losses and updated_row["id"] not in closed and not updated_row["is_active"]:
+                    logging.info("Max StopLoss count has been reached. Deactivating trade: %s", updated_row["id"])
         except Exception:
             logging.exception("Exception occurred handling stop order update: ")
             